@@ -0,0 +1,94 @@
+"""
+    shared setup of the benchmarks, they configure django by themselves so
+    they can run against a throwaway sqlite file or a local postgresql
+    database without a project
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def add_database_options(parser):
+    parser.add_argument("--engine", choices=("sqlite", "postgresql"), default="sqlite")
+    parser.add_argument("--name", default=None,
+                        help="sqlite file or postgresql database (default notify_bench)")
+    parser.add_argument("--user", default=os.environ.get("PGUSER", ""))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--host", default=os.environ.get("PGHOST", ""))
+    parser.add_argument("--port", default=os.environ.get("PGPORT", ""))
+
+
+def configure(args, **extra):
+    """
+        configure django for the database given in the command line and
+        create the tables
+    """
+    from django.conf import settings
+
+    if args.engine == "sqlite":
+        database = {"ENGINE": "django.db.backends.sqlite3",
+                    "NAME": args.name or os.path.join(ROOT, "notify_bench.sqlite3")}
+    else:
+        database = {"ENGINE": "django.db.backends.postgresql_psycopg2",
+                    "NAME": args.name or "notify_bench",
+                    "USER": args.user,
+                    "PASSWORD": args.password,
+                    "HOST": args.host,
+                    "PORT": args.port}
+
+    settings.configure(DATABASES={"default": database},
+                       INSTALLED_APPS=("django.contrib.auth",
+                                       "django.contrib.contenttypes",
+                                       "django_notify_events"),
+                       USE_TZ=True,
+                       SECRET_KEY="notify_bench",
+                       **extra)
+
+    from django.core.management import call_command
+    call_command("syncdb", interactive=False, verbosity=0)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+class Timer(object):
+    """
+        wall time of the with block in milliseconds
+    """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.ms = (time.time() - self.start) * 1000.0
+
+
+class Queries(object):
+    """
+        number of queries executed inside the with block
+    """
+
+    def __enter__(self):
+        from django.db import connection
+
+        self.connection = connection
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *args):
+        self.count = len(self.connection.queries) - self.start
+        self.connection.use_debug_cursor = self.use_debug_cursor
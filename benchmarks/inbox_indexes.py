@@ -0,0 +1,174 @@
+"""
+    query plans and timings of the inbox queries with the indexes of the old
+    schema (only the foreign keys) and with the indexes shipped by the app
+
+    python benchmarks/inbox_indexes.py --rows 2000000
+    python benchmarks/inbox_indexes.py --engine postgresql --name notify_bench
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import time
+
+from common import add_database_options, configure, percentile, Timer
+
+
+def populate(args):
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from django_notify_events.models import Events, Notifications
+
+    if Notifications.objects.exists():
+        return
+
+    User.objects.bulk_create([User(username="bench_%d" % i, password="!") for i in range(args.users)],
+                             batch_size=500)
+    Events.objects.bulk_create([Events(name="bench_%d" % i, description="", category="bench_%d" % (i % 5))
+                                for i in range(args.events)])
+    users = list(User.objects.values_list("pk", flat=True))
+    events = list(Events.objects.values_list("pk", flat=True))
+
+    #built by the ORM so the rows get the defaults of every column
+    now = int(time.time())
+    written = 0
+    while written < args.rows:
+        rows = []
+        for i in range(min(10000, args.rows - written)):
+            dispatch_time = now - random.randint(0, 90 * 24 * 3600)
+            if random.random() < 0.01:
+                dispatch_time = now + random.randint(0, 3600)
+            rows.append(Notifications(user_id=random.choice(users),
+                                      event_id=random.choice(events),
+                                      actor_id=random.choice(users),
+                                      object_type=random.choice(("blog_post", "comment", "photo")),
+                                      object_id=str(random.randint(0, 10000)),
+                                      read=random.random() < args.read_ratio,
+                                      dispatch_time=dispatch_time))
+        Notifications.objects.bulk_create(rows, batch_size=500)
+        transaction.commit_unless_managed()
+        written += len(rows)
+        print("\rpopulating %d/%d" % (written, args.rows), end="")
+    print()
+
+
+def drop_indexes():
+    from django.db import connection
+    from django_notify_events import indexes
+    from django_notify_events.models import Notifications
+
+    table = Notifications._meta.db_table
+    cursor = connection.cursor()
+    for name in indexes.existing_indexes(table, connection):
+        if name.startswith("sqlite_autoindex") or name.endswith("_pkey"):
+            continue
+        cursor.execute("DROP INDEX %s" % connection.ops.quote_name(name))
+
+
+def create_old_indexes():
+    from django.db import connection
+    from django_notify_events.models import Notifications
+
+    qn = connection.ops.quote_name
+    table = Notifications._meta.db_table
+    cursor = connection.cursor()
+    for column in ("user_id", "event_id", "actor_id"):
+        cursor.execute("CREATE INDEX %s ON %s (%s)" % (qn("%s_old_%s" % (table, column)), qn(table), qn(column)))
+
+
+def create_app_indexes():
+    from django.core.management.color import no_style
+    from django.db import connection
+    from django_notify_events import indexes
+    from django_notify_events.models import Notifications
+
+    cursor = connection.cursor()
+    for sql in connection.creation.sql_indexes_for_model(Notifications, no_style()):
+        cursor.execute(sql)
+    indexes.create_partial_indexes(Notifications)
+
+
+def queries(user, actor, event):
+    from django_notify_events.models import Notifications
+
+    now = int(time.time())
+    unread = Notifications.objects.filter(user=user, read=False, dispatch_time__lte=now)
+    return [("inbox page", unread.order_by("-dispatch_time", "-id")[:20]),
+            ("unread count", unread.extra(select={"n": "COUNT(*)"}).values("n")),
+            ("unread of event", unread.filter(event=event)),
+            ("unfollow actor cleanup", unread.filter(actor=actor).values("id"))]
+
+
+def explain(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+
+
+def measure(args, label):
+    from django.db import connection
+    from django_notify_events.models import Events
+
+    connection.cursor().execute("ANALYZE")
+
+    users = list(range(1, args.users + 1))
+    events = list(Events.objects.values_list("pk", flat=True))
+    random.seed(args.seed)
+    samples = [(random.choice(users), random.choice(users), random.choice(events)) for i in range(args.repeat)]
+
+    report = {}
+    for position, (name, queryset) in enumerate(queries(*samples[0])):
+        timings = []
+        for sample in samples:
+            sample_queryset = queries(*sample)[position][1]
+            with Timer() as timer:
+                list(sample_queryset)
+            timings.append(timer.ms)
+        report[name] = {"plan": explain(queryset),
+                        "p50_ms": percentile(timings, 50),
+                        "p99_ms": percentile(timings, 99)}
+
+    print("== %s" % label)
+    for name, result in sorted(report.items()):
+        print("%-24s p50 %8.2f ms  p99 %8.2f ms" % (name, result["p50_ms"], result["p99_ms"]))
+        for line in result["plan"]:
+            print("    %s" % line)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_options(parser)
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--read-ratio", type=float, default=0.9)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    configure(args)
+    populate(args)
+
+    results = {}
+    drop_indexes()
+    create_old_indexes()
+    results["before"] = measure(args, "foreign key indexes only")
+
+    drop_indexes()
+    create_app_indexes()
+    results["after"] = measure(args, "indexes of the app")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
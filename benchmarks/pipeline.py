@@ -0,0 +1,172 @@
+"""
+    throughput, latency and number of queries of the notification pipeline
+    (create_event, add, follow/unfollow and the inbox reads) on a synthetic
+    population of users, events, categories and mute rules
+
+    python benchmarks/pipeline.py --users 10000 --json results.json
+    python benchmarks/pipeline.py --engine postgresql --compare results.json
+
+The database is emptied before each run.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import time
+
+from common import ROOT, add_database_options, configure, percentile, Queries, Timer
+
+
+class Recorder(object):
+    """
+        timings and number of queries of each call of an operation
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def measure(self, operation, function, *args, **kwargs):
+        with Queries() as queries:
+            with Timer() as timer:
+                result = function(*args, **kwargs)
+        self.samples.setdefault(operation, []).append((timer.ms, queries.count))
+        return result
+
+    def report(self):
+        report = {}
+        for name, samples in self.samples.items():
+            timings = [ms for ms, queries in samples]
+            queries = [queries for ms, queries in samples]
+            total = sum(timings)
+            report[name] = {"calls": len(samples),
+                            "throughput": len(samples) / (total / 1000.0) if total else 0.0,
+                            "p50_ms": percentile(timings, 50),
+                            "p99_ms": percentile(timings, 99),
+                            "queries_mean": float(sum(queries)) / len(queries),
+                            "queries_max": max(queries)}
+        return report
+
+
+def populate(args, recorder):
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django_notify_events.models import Events, MuteRules, Subscriptions
+
+    call_command("flush", interactive=False, verbosity=0)
+
+    User.objects.bulk_create([User(username="bench_%d" % i, password="!") for i in range(args.users)],
+                             batch_size=500)
+
+    for i in range(args.events):
+        recorder.measure("create_event", Events.create_event,
+                         "bench_%d" % i, "", "bench_%d" % (i % args.categories))
+
+    #mute some actors in a part of the subscriptions
+    users = list(User.objects.values_list("pk", flat=True))
+    subscriptions = list(Subscriptions.objects.values_list("pk", flat=True))
+    rules = [MuteRules(subscription_id=pk, kind=MuteRules.ACTOR, actor_id=random.choice(users))
+             for pk in random.sample(subscriptions, int(len(subscriptions) * args.muted_ratio))]
+    MuteRules.objects.bulk_create(rules, batch_size=500)
+    return users
+
+
+def run(args, users, recorder):
+    from django.contrib.auth.models import User
+    from django_notify_events.inbox import Inbox
+    from django_notify_events.models import Events, Notifications, Subscriptions
+
+    events = list(Events.objects.all())
+    sample = User.objects.in_bulk(random.sample(users, min(args.repeat, len(users))))
+    sample = list(sample.values())
+
+    created = 0
+    for i in range(args.repeat):
+        event = random.choice(events)
+        before = Notifications.objects.count()
+        recorder.measure("add", Events.add,
+                         name=event.name,
+                         description=event.description,
+                         category=event.category,
+                         actor=random.choice(sample),
+                         object_type="blog_post",
+                         object_id=str(i),
+                         outbox=False)
+        created += Notifications.objects.count() - before
+
+    for user in sample:
+        actor = random.choice(sample)
+        category = random.choice(events).category
+        recorder.measure("unfollow actor", Subscriptions.unfollow, follower=user, actor=actor)
+        recorder.measure("follow actor", Subscriptions.follow, follower=user, actor=actor)
+        recorder.measure("unfollow category", Subscriptions.unfollow, follower=user, category=category)
+        recorder.measure("follow category", Subscriptions.follow, follower=user, category=category)
+
+    for user in sample:
+        recorder.measure("inbox get", lambda: list(Notifications.get(user=user).order_by("-dispatch_time")[:20]))
+        recorder.measure("inbox page", Inbox(user).page)
+        recorder.measure("unread count", Notifications.unread_count, user)
+
+    return created
+
+
+def print_report(report, baseline=None):
+    print("%-20s %8s %12s %10s %10s %9s" % ("operation", "calls", "per second", "p50 ms", "p99 ms", "queries"))
+    for name, result in sorted(report.items()):
+        line = "%-20s %8d %12.1f %10.2f %10.2f %9.1f" % (name, result["calls"], result["throughput"],
+                                                         result["p50_ms"], result["p99_ms"],
+                                                         result["queries_mean"])
+        old = (baseline or {}).get(name)
+        if old and old["p50_ms"]:
+            line += "   p50 x%.2f, queries %+.1f" % (result["p50_ms"] / old["p50_ms"],
+                                                    result["queries_mean"] - old["queries_mean"])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_database_options(parser)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--muted-ratio", type=float, default=0.1,
+                        help="part of the subscriptions with a muted actor")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--compare", default=None, help="results of a previous run to compare with")
+    args = parser.parse_args()
+
+    if args.name is None:
+        #keep away from the big tables of inbox_indexes.py
+        if args.engine == "sqlite":
+            args.name = os.path.join(ROOT, "notify_pipeline.sqlite3")
+        else:
+            args.name = "notify_pipeline"
+
+    configure(args)
+    random.seed(args.seed)
+    recorder = Recorder()
+
+    started = time.time()
+    users = populate(args, recorder)
+    notifications = run(args, users, recorder)
+
+    report = recorder.report()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_report(report, baseline)
+    print("%d notifications created in %.1f s" % (notifications, time.time() - started))
+
+    if args.json:
+        config = dict((key, getattr(args, key)) for key in ("engine", "users", "events", "categories",
+                                                             "muted_ratio", "repeat", "seed"))
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": report}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
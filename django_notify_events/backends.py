@@ -0,0 +1,239 @@
+"""
+    delivery backends of the notify channels. NOTIFY_EVENTS_CHANNELS maps the
+    channel names to a backend, the notifications of a channel without entry
+    go to the "default" one:
+
+    NOTIFY_EVENTS_CHANNELS = {
+        "default": {"BACKEND": "django_notify_events.backends.LogBackend"},
+        "email": {"BACKEND": "django_notify_events.backends.EmailBackend"},
+        "hooks": {"BACKEND": "django_notify_events.backends.WebhookBackend",
+                  "OPTIONS": {"URL": "https://example.com/notifications"}},
+    }
+"""
+import json
+import logging
+
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.template.loader import render_to_string
+from django.test.signals import setting_changed
+
+from django_notify_events.conf import settings
+from django_notify_events.dispatch import load
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlparse
+
+
+logger = logging.getLogger("django_notify_events")
+
+#notifications delivered by the LocMemBackend, for the tests
+outbox = []
+
+_backends = {}
+
+
+def get_backend(channel):
+    """
+        backend of the channel, the instances are kept so they can reuse
+        their connections between batches
+    """
+    if channel not in _backends:
+        config = settings.CHANNELS.get(channel, settings.CHANNELS.get("default"))
+        if config is None:
+            raise ImproperlyConfigured("there is no backend for the notify channel %s" % channel)
+        _backends[channel] = load(config["BACKEND"])(channel, **config.get("OPTIONS", {}))
+    return _backends[channel]
+
+
+def close_backends(**kwargs):
+    for backend in _backends.values():
+        backend.close()
+    _backends.clear()
+
+
+def _setting_changed(setting, **kwargs):
+    if setting == "NOTIFY_EVENTS_CHANNELS":
+        close_backends()
+
+setting_changed.connect(_setting_changed)
+
+
+def deliver(notifications):
+    """
+        dispatch handler, send the notifications of each channel with one
+        call to its backend and return the ones that failed
+    """
+    channels = {}
+    for notification in notifications:
+        channels.setdefault(notification.notify_channel, []).append(notification)
+
+    failed = []
+    for channel, channel_notifications in channels.items():
+        try:
+            failed.extend(get_backend(channel).send(channel_notifications))
+        except Exception:
+            logger.exception("delivery of %d notifications through %s failed", len(channel_notifications), channel)
+            failed.extend(channel_notifications)
+    return failed
+
+
+def serialize(notification):
+    return {"id": notification.pk,
+            "user": notification.user_id,
+            "event": notification.event.name,
+            "category": notification.event.category,
+            "actor": notification.actor_id,
+            "actors": notification.actor_ids,
+            "count": notification.count,
+            "object_type": notification.object_type,
+            "object_id": notification.object_id,
+            "extra_data": notification.data,
+            "dispatch_time": notification.dispatch_time}
+
+
+class BaseBackend(object):
+    """
+        deliver the notifications of a channel, send receives a batch and
+        returns the notifications that failed
+    """
+
+    def __init__(self, channel, **options):
+        self.channel = channel
+        self.options = options
+
+    def send(self, notifications):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LogBackend(BaseBackend):
+    """
+        only log the notifications
+    """
+
+    def send(self, notifications):
+        for notification in notifications:
+            logger.info("notification %s for %s through %s", notification.pk,
+                        notification.user_id, notification.notify_channel)
+        return []
+
+
+class LocMemBackend(BaseBackend):
+    """
+        keep the notifications in backends.outbox, for the tests
+    """
+
+    def send(self, notifications):
+        outbox.extend(notifications)
+        return []
+
+
+class FileBackend(BaseBackend):
+    """
+        append the notifications as json lines to the file in the PATH option
+    """
+
+    def send(self, notifications):
+        with open(self.options["PATH"], "a") as f:
+            for notification in notifications:
+                f.write(json.dumps(serialize(notification)) + "\n")
+        return []
+
+
+class EmailBackend(BaseBackend):
+    """
+        send one email per notification through a single connection of the
+        django email backend (option EMAIL_BACKEND, default the one of the
+        settings). The options SUBJECT_TEMPLATE and BODY_TEMPLATE are
+        rendered with the notification in the context. The notifications
+        whose email could not be sent, or whose user has no email, failed.
+    """
+
+    def send(self, notifications):
+        failed = []
+        connection = mail.get_connection(self.options.get("EMAIL_BACKEND"))
+        connection.open()
+        try:
+            for notification in notifications:
+                if not notification.user.email:
+                    logger.warning("notification %s: the user %s has no email", notification.pk, notification.user_id)
+                    failed.append(notification)
+                    continue
+                try:
+                    message = mail.EmailMessage(self.subject(notification),
+                                                self.body(notification),
+                                                to=[notification.user.email],
+                                                connection=connection)
+                    if not connection.send_messages([message]):
+                        raise IOError("the email was not sent")
+                except Exception:
+                    logger.exception("email of the notification %s failed", notification.pk)
+                    failed.append(notification)
+        finally:
+            connection.close()
+        return failed
+
+    def subject(self, notification):
+        if "SUBJECT_TEMPLATE" in self.options:
+            return render_to_string(self.options["SUBJECT_TEMPLATE"], {"notification": notification}).strip()
+        return notification.event.description.splitlines()[0] if notification.event.description else ""
+
+    def body(self, notification):
+        if "BODY_TEMPLATE" in self.options:
+            return render_to_string(self.options["BODY_TEMPLATE"], {"notification": notification})
+        return json.dumps(serialize(notification), indent=2)
+
+
+class WebhookBackend(BaseBackend):
+    """
+        POST the notifications as a json list to the URL option, BATCH
+        (default 100) notifications per request through a persistent
+        connection
+    """
+
+    def __init__(self, channel, **options):
+        super(WebhookBackend, self).__init__(channel, **options)
+        self.url = urlparse(options["URL"])
+        self.connection = None
+
+    def send(self, notifications):
+        batch = self.options.get("BATCH", 100)
+        failed = []
+        for start in range(0, len(notifications), batch):
+            chunk = notifications[start:start + batch]
+            try:
+                self.post([serialize(notification) for notification in chunk])
+            except Exception:
+                logger.exception("webhook %s failed", self.options["URL"])
+                self.close()
+                failed.extend(chunk)
+        return failed
+
+    def post(self, payload):
+        if self.connection is None:
+            connection_class = HTTPSConnection if self.url.scheme == "https" else HTTPConnection
+            self.connection = connection_class(self.url.netloc, timeout=self.options.get("TIMEOUT", 10))
+
+        path = self.url.path or "/"
+        if self.url.query:
+            path += "?" + self.url.query
+
+        headers = {"Content-Type": "application/json"}
+        headers.update(self.options.get("HEADERS", {}))
+        self.connection.request("POST", path, json.dumps(payload), headers)
+        response = self.connection.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise IOError("webhook answered %s" % response.status)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,119 @@
+from django.conf import settings as django_settings
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+
+
+class Settings(object):
+    """
+        app settings, every value can be overridden in the django settings
+        with the NOTIFY_EVENTS_ prefix, e.g. NOTIFY_EVENTS_BATCH_SIZE = 1000
+    """
+
+    defaults = {
+        #max number of notifications written per INSERT during the fan-out
+        "BATCH_SIZE": 500,
+        #store the occurrences in the outbox instead of doing the fan-out
+        #inside Events.add
+        "OUTBOX": False,
+        #seconds a worker keeps the claim over an occurrence of the outbox
+        "OUTBOX_LEASE": 300,
+        #claims of an occurrence before giving up on it
+        "OUTBOX_MAX_ATTEMPTS": 5,
+        #events created with at least this number of subscriptions are in
+        #fan-out on read mode, None to never turn it on automatically
+        "PULL_THRESHOLD": None,
+        #seconds an occurrence in fan-out on read mode waits before it can be
+        #pulled, an occurrence committed more than this delay after a newer
+        #one is skipped by the pulls
+        "PULL_DELAY": 2,
+        #seconds the id of the newest occurrence in fan-out on read mode is
+        #cached, the reads of the inbox check it before pulling
+        "PULL_CHECK_INTERVAL": 1,
+        #don't store the subscriptions of the auto subscription events, every
+        #user follows them until follow/unfollow stores a subscription that
+        #overrides the default one
+        "SPARSE_SUBSCRIPTIONS": False,
+        #aliases of the databases that store the notifications, see routers
+        "SHARDS": None,
+        #replica aliases of each database for the reads of a user, see routers
+        "REPLICAS": None,
+        #seconds the reads of a user go to the primary after a change
+        "REPLICA_STICKY_SECONDS": 10,
+        #seconds between the checks of the events changed by other processes
+        "REGISTRY_CHECK_INTERVAL": 1,
+        #actors kept in a coalesced notification
+        "COALESCE_MAX_ACTORS": 10,
+        #callable (or dotted path) that delivers a list of notifications and
+        #returns the ones that failed
+        "DISPATCH_HANDLER": "django_notify_events.backends.deliver",
+        #backend of each notify channel, see backends
+        "CHANNELS": {"default": {"BACKEND": "django_notify_events.backends.LogBackend"}},
+        #seconds a dispatcher keeps the claim over a notification
+        "DISPATCH_LEASE": 60,
+        #seconds before a failed notification is tried again
+        "DISPATCH_RETRY_DELAY": 60,
+        #deliveries of a notification tried before giving up on it
+        "DISPATCH_MAX_ATTEMPTS": 5,
+        #days the read notifications and the processed occurrences are kept
+        #by notify_purge, None to keep them forever
+        "RETENTION_DAYS": None,
+        #read notifications kept by notify_purge for each user, None for no
+        #limit
+        "RETENTION_MAX_PER_USER": None,
+        #seconds the idempotency keys of Events.add are kept, see
+        #notify_purge
+        "IDEMPOTENCY_KEY_TTL": 7 * 24 * 3600,
+        #broker that wakes the clients of views.poll_view and
+        #views.stream_view, see pubsub, None to turn it off
+        "PUBSUB_BROKER": "django_notify_events.pubsub.InMemoryBroker",
+        #max seconds a long-poll waits for new notifications
+        "PUBSUB_TIMEOUT": 25,
+        #seconds between the keepalive comments of a stream
+        "PUBSUB_HEARTBEAT": 15,
+        #seconds a stream stays open, the client reconnects after it
+        "PUBSUB_STREAM_SECONDS": 300,
+        #sink of the metrics, see metrics, None to turn them off
+        "METRICS_SINK": "django_notify_events.metrics.Aggregator",
+        #count the followers left out of each fan-out by the database (self,
+        #inactive, muted actor, rule), it costs four more queries per fan-out
+        "METRICS_SUPPRESSIONS": False,
+    }
+
+    def __getattr__(self, name):
+        if name not in self.defaults:
+            raise AttributeError(name)
+        return getattr(django_settings, "NOTIFY_EVENTS_%s" % name, self.defaults[name])
+
+
+settings = Settings()
+
+
+def load(path):
+    """
+        return the object of a dotted path, callables are returned as they are
+    """
+    if callable(path):
+        return path
+    module, name = path.rsplit(".", 1)
+    return getattr(import_module(module), name)
+
+
+_instances = {}
+
+
+def instance(name):
+    """
+        instance of the class of the setting name (dotted path, None gives
+        None), created once until the setting changes
+    """
+    if name not in _instances:
+        path = getattr(settings, name)
+        _instances[name] = None if path is None else load(path)()
+    return _instances[name]
+
+
+def _setting_changed(setting, **kwargs):
+    if setting.startswith("NOTIFY_EVENTS_"):
+        _instances.pop(setting[len("NOTIFY_EVENTS_"):], None)
+
+setting_changed.connect(_setting_changed)
@@ -0,0 +1,101 @@
+import logging
+import os
+import socket
+import time
+import uuid
+
+from django_notify_events import pubsub
+from django_notify_events.conf import load, settings
+from django_notify_events.models import Notifications
+
+
+logger = logging.getLogger("django_notify_events")
+
+
+def worker_name():
+    """
+        unique name of a worker process, used to claim rows
+    """
+    return "%s:%s:%s" % (socket.gethostname()[:40], os.getpid(), uuid.uuid4().hex[:8])
+
+
+def delayed(notification):
+    """
+        True if the notification was not visible when it was written
+    """
+    if notification.occurrence_id is None:
+        return True
+    return notification.dispatch_time > notification.occurrence.created
+
+
+class Dispatcher(object):
+    """
+        deliver the notifications whose dispatch time arrived, the oldest
+        first and in batches. Many dispatchers can run at the same time, each
+        notification is claimed by only one of them. The notifications
+        without notify channel are marked as delivered without calling the
+        handler, the default handler (backends.deliver) sends each channel
+        through its backend.
+    """
+
+    def __init__(self, batch_size=None, lease=None, handler=None, worker=None):
+        self.batch_size = batch_size or settings.BATCH_SIZE
+        self.lease = lease
+        self.handler = load(handler or settings.DISPATCH_HANDLER)
+        self.worker = worker or worker_name()
+
+    def dispatch(self):
+        """
+            deliver one batch, return the stats of the batch: notifications
+            claimed, delivered and failed, seconds spent, throughput
+            (notifications per second) and lag (seconds between the oldest
+            dispatch time of the batch and now)
+        """
+        start = time.time()
+        stats = {"claimed": 0, "delivered": 0, "failed": 0, "seconds": 0.0, "throughput": 0.0, "lag": 0.0}
+
+        notifications = Notifications.claim(self.worker, self.batch_size, lease=self.lease)
+        if not notifications:
+            return stats
+
+        pending = [notification for notification in notifications if notification.notify_channel]
+        try:
+            failed = list(self.handler(pending)) if pending else []
+        except Exception:
+            logger.exception("delivery of %d notifications failed", len(pending))
+            failed = pending
+
+        failed_ids = set(notification.pk for notification in failed)
+        delivered = [notification for notification in notifications if notification.pk not in failed_ids]
+        Notifications.mark_delivered(self.worker, delivered)
+        if failed:
+            Notifications.mark_failed(self.worker, failed)
+
+        #the fan-out woke the followers of the notifications visible right
+        #away, the ones delayed by the period of the subscription are woken
+        #the first time they are claimed
+        pubsub.publish([notification for notification in notifications
+                        if notification.attempts == 1 and delayed(notification)])
+
+        seconds = time.time() - start
+        stats.update(claimed=len(notifications),
+                     delivered=len(delivered),
+                     failed=len(failed),
+                     seconds=seconds,
+                     throughput=len(notifications) / seconds if seconds else 0.0,
+                     lag=max(start - min(n.dispatch_time for n in notifications), 0))
+
+        logger.info("dispatched %(delivered)d notifications (%(failed)d failed) in %(seconds).3fs, "
+                    "%(throughput).1f/s, lag %(lag).1fs", stats)
+        return stats
+
+    def run(self, sleep=1.0, once=False):
+        """
+            dispatch until there is nothing left (once) or forever
+        """
+        while True:
+            stats = self.dispatch()
+            if not stats["claimed"]:
+                if once:
+                    return
+                time.sleep(sleep)
@@ -0,0 +1,109 @@
+import base64
+
+from django.db.models import Q
+
+from django_notify_events import routers
+from django_notify_events.models import Notifications
+
+
+def encode_cursor(notification):
+    return base64.urlsafe_b64encode("%d:%d" % (notification.dispatch_time, notification.pk)).rstrip("=")
+
+
+#cursor before any notification
+FIRST_CURSOR = base64.urlsafe_b64encode("0:0").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        cursor = str(cursor)
+        dispatch_time, pk = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).split(":")
+        return int(dispatch_time), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("invalid cursor %r" % cursor)
+
+
+class InboxPage(object):
+    """
+        a page of notifications and the cursor of the next one (None on the
+        last page)
+    """
+
+    def __init__(self, notifications, next_cursor):
+        self.notifications = notifications
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.notifications)
+
+    def __len__(self):
+        return len(self.notifications)
+
+
+class Inbox(object):
+    """
+        unread notifications of a user, newest first. The pages are read by
+        (dispatch_time, id) ranges instead of offsets so any page costs the
+        same as the first one.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    def page(self, cursor=None, limit=20, event=None, category=None, object_type=None):
+        queryset = Notifications.get(user=self.user)
+        if event is not None:
+            queryset = queryset.filter(event=event)
+        if category is not None:
+            queryset = Notifications.of_category(queryset, category)
+        if object_type is not None:
+            queryset = queryset.filter(object_type=object_type)
+
+        if cursor is not None:
+            dispatch_time, pk = decode_cursor(cursor)
+            queryset = queryset.filter(Q(dispatch_time__lt=dispatch_time) |
+                                       Q(dispatch_time=dispatch_time, pk__lt=pk))
+
+        #one more row tells if there is a next page
+        notifications = list(Notifications.with_related(queryset, "event", "actor", "occurrence")
+                                          .order_by("-dispatch_time", "-pk")[:limit + 1])
+
+        next_cursor = None
+        if len(notifications) > limit:
+            notifications = notifications[:limit]
+            next_cursor = encode_cursor(notifications[-1])
+
+        return InboxPage(notifications, next_cursor)
+
+    def latest_cursor(self):
+        """
+            cursor of the newest notification, to read the ones after it
+            with newer
+        """
+        queryset = Notifications.get(user=self.user).order_by("-dispatch_time", "-pk")
+        for notification in queryset[:1]:
+            return encode_cursor(notification)
+        return FIRST_CURSOR
+
+    def newer(self, cursor, limit=20, primary=False):
+        """
+            unread notifications after the cursor, oldest first. next_cursor
+            is the cursor of the last one (the same cursor if there are
+            none). With primary they are read from the primary database, use
+            it after a wake up of pubsub, the replicas could be behind.
+        """
+        dispatch_time, pk = decode_cursor(cursor)
+        queryset = Notifications.get(user=self.user).filter(Q(dispatch_time__gt=dispatch_time) |
+                                                            Q(dispatch_time=dispatch_time, pk__gt=pk))
+        if primary:
+            queryset = routers.for_write(queryset)
+
+        notifications = list(Notifications.with_related(queryset, "event", "actor", "occurrence")
+                                          .order_by("dispatch_time", "pk")[:limit])
+        if notifications:
+            cursor = encode_cursor(notifications[-1])
+        return InboxPage(notifications, cursor)
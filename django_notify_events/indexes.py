@@ -0,0 +1,74 @@
+"""
+    partial indexes, django can not declare them in the models so they are
+    created after syncdb on the backends that support them
+"""
+import sqlite3
+
+from django.db import connections
+
+
+def partial_indexes(model):
+    """
+        return a list of (name, table, columns, condition) for the model
+    """
+    from django_notify_events.models import Notifications
+
+    if model is Notifications:
+        table = model._meta.db_table
+        #inbox of a user, Notifications.get only reads unread rows
+        return [("%s_unread" % table, table, ("user_id", "dispatch_time", "id"), ("read", False))]
+    return []
+
+
+def supports_partial_indexes(connection):
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return sqlite3.sqlite_version_info >= (3, 8, 0)
+    return False
+
+
+def sql_partial_indexes(model, connection):
+    if not supports_partial_indexes(connection):
+        return []
+
+    qn = connection.ops.quote_name
+    statements = []
+    for name, table, columns, (column, value) in partial_indexes(model):
+        if connection.vendor == "sqlite":
+            value = int(value)
+        else:
+            value = "true" if value else "false"
+
+        statements.append("CREATE INDEX %s ON %s (%s) WHERE %s = %s" % (qn(name),
+                                                                      qn(table),
+                                                                      ", ".join(qn(c) for c in columns),
+                                                                      qn(column),
+                                                                      value))
+    return statements
+
+
+def existing_indexes(table, connection):
+    cursor = connection.cursor()
+    if connection.vendor == "postgresql":
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [table])
+    elif connection.vendor == "sqlite":
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+    else:
+        return set()
+    return set(row[0] for row in cursor.fetchall())
+
+
+def create_partial_indexes(model, using="default"):
+    connection = connections[using]
+    existing = existing_indexes(model._meta.db_table, connection)
+    cursor = connection.cursor()
+    for (name, table, columns, condition), sql in zip(partial_indexes(model),
+                                                      sql_partial_indexes(model, connection)):
+        if name not in existing:
+            cursor.execute(sql)
+
+
+def create_partial_indexes_after_syncdb(sender, created_models, db="default", **kwargs):
+    for model in created_models:
+        create_partial_indexes(model, db)
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_notify_events.dispatch import Dispatcher
+
+
+class Command(BaseCommand):
+    help = "Deliver the notifications whose dispatch time arrived, many dispatchers can run at the same time"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int", default=None,
+                    help="Number of notifications claimed at once"),
+        make_option("--lease", dest="lease", type="int", default=None,
+                    help="Seconds the dispatcher keeps the claim over a notification"),
+        make_option("--sleep", dest="sleep", type="float", default=1.0,
+                    help="Seconds to wait when there is nothing to deliver"),
+        make_option("--once", dest="once", action="store_true", default=False,
+                    help="Exit when there is nothing to deliver"),
+    )
+
+    def handle(self, *args, **options):
+        Dispatcher(batch_size=options["batch_size"], lease=options["lease"]).run(sleep=options["sleep"],
+                                                                                 once=options["once"])
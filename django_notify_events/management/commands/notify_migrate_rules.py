@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_notify_events.models import Subscriptions
+
+
+class Command(BaseCommand):
+    help = "Move the legacy unfollow_actors and rules fields of the subscriptions to MuteRules"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int", default=None,
+                    help="Number of subscriptions migrated per transaction"),
+    )
+
+    def handle(self, *args, **options):
+        created = Subscriptions.migrate_legacy_rules(batch_size=options["batch_size"])
+        self.stdout.write("%d rules created" % created)
@@ -0,0 +1,48 @@
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_notify_events.dispatch import worker_name
+from django_notify_events.models import Occurrences, LeaseLost
+
+
+logger = logging.getLogger("django_notify_events")
+
+
+class Command(BaseCommand):
+    help = "Fan-out the occurrences stored in the outbox, many workers can run at the same time"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--claim", dest="claim", type="int", default=10,
+                    help="Number of occurrences claimed at once"),
+        make_option("--batch-size", dest="batch_size", type="int", default=None,
+                    help="Number of notifications written per INSERT"),
+        make_option("--lease", dest="lease", type="int", default=None,
+                    help="Seconds the worker keeps the claim over an occurrence"),
+        make_option("--sleep", dest="sleep", type="float", default=1.0,
+                    help="Seconds to wait when the outbox is empty"),
+        make_option("--once", dest="once", action="store_true", default=False,
+                    help="Exit when the outbox is empty"),
+    )
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+
+        while True:
+            occurrences = Occurrences.claim(worker, options["claim"], lease=options["lease"])
+            if not occurrences:
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
+                continue
+
+            for occurrence in occurrences:
+                try:
+                    occurrence.process(batch_size=options["batch_size"], lease=options["lease"])
+                except LeaseLost as e:
+                    logger.warning("%s", e)
+                except Exception:
+                    #the occurrence is claimed again when the lease expires
+                    logger.exception("fan-out of the occurrence %s failed", occurrence.pk)
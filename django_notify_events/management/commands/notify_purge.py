@@ -0,0 +1,49 @@
+from optparse import make_option
+import gzip
+import json
+
+from django.core.management.base import BaseCommand
+
+from django_notify_events.backends import serialize
+from django_notify_events.models import Notifications, Occurrences
+
+
+class Command(BaseCommand):
+    help = ("Delete the read notifications and the processed occurrences out of the retention policy "
+            "and expire the old idempotency keys")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--days", dest="days", type="int", default=None,
+                    help="Delete the read notifications older than this (default NOTIFY_EVENTS_RETENTION_DAYS)"),
+        make_option("--max-per-user", dest="max_per_user", type="int", default=None,
+                    help="Read notifications kept for each user (default NOTIFY_EVENTS_RETENTION_MAX_PER_USER)"),
+        make_option("--batch-size", dest="batch_size", type="int", default=None,
+                    help="Number of rows deleted per transaction"),
+        make_option("--archive", dest="archive", default=None,
+                    help="Append the deleted notifications to this gzip file, one json per line"),
+    )
+
+    def handle(self, *args, **options):
+        archive = None
+        archive_file = None
+        if options["archive"]:
+            archive_file = gzip.open(options["archive"], "ab")
+
+            def archive(notifications):
+                for notification in notifications:
+                    archive_file.write((json.dumps(serialize(notification)) + "\n").encode("utf-8"))
+                archive_file.flush()
+
+        try:
+            notifications = Notifications.purge(days=options["days"],
+                                                max_per_user=options["max_per_user"],
+                                                batch_size=options["batch_size"],
+                                                archive=archive)
+        finally:
+            if archive_file is not None:
+                archive_file.close()
+
+        occurrences = Occurrences.purge(days=options["days"], batch_size=options["batch_size"])
+        keys = Occurrences.expire_keys(batch_size=options["batch_size"])
+        self.stdout.write("%d notifications and %d occurrences deleted, %d idempotency keys expired"
+                          % (notifications, occurrences, keys))
@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_notify_events.models import UnreadCounters
+
+
+class Command(BaseCommand):
+    help = "Compute again the unread counters of the users from their notifications"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int", default=None,
+                    help="Number of users reconciled per transaction"),
+    )
+
+    def handle(self, *args, **options):
+        repaired = UnreadCounters.reconcile(batch_size=options["batch_size"])
+        self.stdout.write("%d counters repaired" % repaired)
@@ -0,0 +1,103 @@
+"""
+    instrumentation of Events.add and of the fan-out. The metrics go to the
+    sink of NOTIFY_EVENTS_METRICS_SINK (dotted path of a class, None to turn
+    them off), which implements:
+
+    increment(name, value, **labels)
+    timing(name, seconds, **labels)
+
+    The default Aggregator keeps them in the memory of the process and
+    exports them in the prometheus text format (views.metrics).
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django_notify_events.conf import instance
+
+
+class Aggregator(object):
+    """
+        in-process sink, counters and the count and sum of the timings
+    """
+
+    prefix = "notify_events"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total = self.timings.get(key, (0, 0.0))
+            self.timings[key] = (count + 1, total + seconds)
+
+    def value(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            name = "%s_%s_total" % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s counter" % name)
+            lines.append("%s%s %s" % (name, _labels(labels), value))
+
+        for (name, labels), (count, total) in timings:
+            name = "%s_%s_seconds" % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s summary" % name)
+            lines.append("%s_count%s %d" % (name, _labels(labels), count))
+            lines.append("%s_sum%s %.6f" % (name, _labels(labels), total))
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def get_sink():
+    return instance("METRICS_SINK")
+
+
+def increment(name, value=1, **labels):
+    sink = get_sink()
+    if sink is not None and value:
+        sink.increment(name, value, **labels)
+
+
+def timing(name, seconds, **labels):
+    sink = get_sink()
+    if sink is not None:
+        sink.timing(name, seconds, **labels)
+
+
+@contextmanager
+def timed(name, **labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timing(name, time.time() - start, **labels)
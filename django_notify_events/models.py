@@ -1,9 +1,60 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Min
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.signals import post_save, pre_delete, post_delete, post_syncdb
+import calendar
+import heapq
+import itertools
+import logging
+import sys
 import time
 import json
+import uuid
+
+from django_notify_events import metrics, pubsub, routers
+from django_notify_events.conf import settings
+from django_notify_events.registry import registry
+from django_notify_events.signals import category_changed
+from django_notify_events.indexes import create_partial_indexes_after_syncdb
+
+
+logger = logging.getLogger("django_notify_events")
+
+
+#default value of the legacy Subscriptions.rules field
+LEGACY_RULES = "[[],[],[],[]]"
+
+
+def delete_in_batches(queryset, batch_size, archive=None):
+    """
+        delete the rows of the queryset in primary key order, batch_size rows
+        per transaction so the locks are short. archive is called with each
+        batch of rows before they are deleted. Return the number of rows
+        deleted.
+    """
+    model = queryset.model
+    deleted = 0
+    last = 0
+    while True:
+        with transaction.commit_on_success():
+            chunk = queryset.filter(pk__gt=last).order_by("pk")[:batch_size]
+            if archive is None:
+                ids = list(chunk.values_list("pk", flat=True))
+            else:
+                rows = list(chunk)
+                ids = [row.pk for row in rows]
+                if rows:
+                    archive(rows)
+
+            if not ids:
+                return deleted
+            model.objects.using(queryset.db).filter(pk__in=ids).delete()
+
+        deleted += len(ids)
+        last = ids[-1]
 
 
 class Events(models.Model):
@@ -24,6 +75,15 @@ class Events(models.Model):
 
     auto_subscription = models.BooleanField(default=True)
 
+    #store the occurrences once and merge them in the inbox of the
+    #followers when they read it (see Notifications.pull)
+    fan_out_on_read = models.BooleanField(default=False)
+
+    #merge the occurrences about the same object that arrive while the
+    #notification of a user is waiting for its dispatch time (the period of
+    #the subscription) in that notification
+    coalesce = models.BooleanField(default=False)
+
     @classmethod
     def do_filter(cls, filter=None, *args, **kwargs):
         if filter is not None:
@@ -34,20 +94,54 @@ class Events(models.Model):
                 raise TypeError("filter must return a bool")
         return True
 
+    @classmethod
+    def do_batch_filter(cls, batch_filter, follower_ids, *args, **kwargs):
+        """
+            return the set of the follower ids allowed by batch_filter
+        """
+        ret = batch_filter(follower_ids, *args, **kwargs)
+        if ret is None or isinstance(ret, bool):
+            raise TypeError("batch_filter must return the allowed follower ids")
+        return set(ret)
+
+    @classmethod
+    def set_category_active(cls, category, active):
+        """
+            turn on or off every event of the category with one UPDATE and
+            return the ids of the events changed. No signal is sent per event,
+            category_changed is sent once instead.
+        """
+        events = cls.objects.filter(category=category).exclude(active=active)
+        with transaction.commit_on_success():
+            event_ids = list(events.values_list("pk", flat=True))
+            if event_ids:
+                cls.objects.filter(pk__in=event_ids).update(active=active)
+
+        if event_ids:
+            category_changed.send(sender=cls, category=category, active=active, event_ids=event_ids)
+        return event_ids
+
     @classmethod
     def deactivate_category(cls, category):
-        for event in cls.objects.filter(category=category):
-            event.active = False
-            event.save()
+        return cls.set_category_active(category, False)
 
     @classmethod
     def activate_category(cls, category):
-        for event in cls.objects.filter(category=category):
-            event.active = True
-            event.save()
+        return cls.set_category_active(category, True)
 
     @classmethod
-    def create_event(cls, name, description, category, auto_subscription=True):
+    def categories(cls, ids):
+        """
+            category of each event id
+        """
+        return dict(cls.objects.filter(pk__in=set(ids)).values_list("pk", "category"))
+
+    @classmethod
+    def create_event(cls, name, description, category, auto_subscription=True, progress=None):
+        event = registry.get(name)
+        if event is not None:
+            return event
+
         try:
             event = cls.objects.get(name=name)
         except ObjectDoesNotExist:
@@ -57,82 +151,215 @@ class Events(models.Model):
                                        auto_subscription=auto_subscription)
 
             if auto_subscription:
-                #create default subscriptions
-                users = User.objects.all()
-
-                #get all events of the category
-                events_of_this_category = cls.objects.filter(category=category)
-
-                for user in users:
-                    #get min period register for this category
-                    min_period = Subscriptions.objects.filter(follower=user,
-                                                              event__in=events_of_this_category).aggregate(Min('period'))
+                if settings.SPARSE_SUBSCRIPTIONS:
+                    #the subscriptions are implicit
+                    followers = User.objects.count() if settings.PULL_THRESHOLD is not None else 0
+                else:
+                    #create default subscriptions
+                    followers = Subscriptions.subscribe_all(event, progress=progress)
 
-                    min_period = 0 if min_period["period__min"] is None else min_period["period__min"]
-                    Subscriptions.objects.create(follower=user,
-                                                 event=event,
-                                                 period=min_period)
+                if settings.PULL_THRESHOLD is not None and followers >= settings.PULL_THRESHOLD:
+                    event.fan_out_on_read = True
+                    event.save()
 
+        registry.add(event)
         return event
 
     @classmethod
     def add(cls, **kwargs):
+        """
+            register an occurrence of the event and notify the followers. With
+            outbox=True (default NOTIFY_EVENTS_OUTBOX) the occurrence is only
+            stored and the fan-out is left to the notify_outbox_worker command.
+            The occurrences of events with fan_out_on_read are stored once and
+            read by the followers from there. A filter can not be stored so
+            it always forces the synchronous fan-out. filter(subscription=...,
+            **kwargs) is called for each follower, prefer batch_filter(ids,
+            **kwargs) when the filter reads the database: it is called once
+            per batch of follower ids and returns the ids to notify. A retry
+            with the idempotency_key of a stored occurrence does nothing.
+        """
         kwargs.setdefault("extra_data", {})
         kwargs.setdefault("notify_channel", None)
         kwargs.setdefault("filter", None)
+        kwargs.setdefault("batch_filter", None)
         kwargs.setdefault("auto_subscription", True)
+        kwargs.setdefault("batch_size", settings.BATCH_SIZE)
+        kwargs.setdefault("outbox", settings.OUTBOX)
         filter = kwargs.pop("filter")
+        batch_filter = kwargs.pop("batch_filter")
+        batch_size = kwargs.pop("batch_size")
+        outbox = kwargs.pop("outbox")
+        idempotency_key = kwargs.pop("idempotency_key", None)
         try:
             #get event if exist
-            event = cls.create_event(kwargs["name"],
-                                     kwargs["description"],
-                                     kwargs["category"],
-                                     kwargs["auto_subscription"])
+            with metrics.timed("add", phase="resolve"):
+                event = cls.create_event(kwargs["name"],
+                                         kwargs["description"],
+                                         kwargs["category"],
+                                         kwargs["auto_subscription"])
 
             if event.active:
-                #create notifications
+                if idempotency_key is not None and Occurrences.objects.filter(idempotency_key=idempotency_key).exists():
+                    metrics.increment("occurrences", mode="duplicate")
+                    return event
 
-                #get generals active subs of the event
-                for sub in Subscriptions.get(event=event):
+                occurrence = Occurrences.build(event, kwargs)
+                occurrence.idempotency_key = idempotency_key
 
-                    if sub.follower == kwargs["actor"]:
-                        continue
+                synchronous = filter is not None or batch_filter is not None
+                if event.fan_out_on_read and not synchronous:
+                    occurrence.pull = True
+                    occurrence.status = Occurrences.DONE
+                    with metrics.timed("add", phase="store"):
+                        stored = occurrence.store()
+                    if stored:
+                        Occurrences.announce_pull(occurrence.pk)
+                    mode = "pull"
+                elif outbox and not synchronous:
+                    with metrics.timed("add", phase="store"):
+                        stored = occurrence.store()
+                    mode = "outbox"
+                else:
+                    #the notifications share the payload of the occurrence,
+                    #with a key they are committed together so a retry after
+                    #a failure is not taken for a duplicate
+                    occurrence.status = Occurrences.DONE
+                    with metrics.timed("add", phase="fan_out"):
+                        if idempotency_key is None:
+                            stored = occurrence.store()
+                            Notifications.fan_out(occurrence, filter, batch_size, batch_filter=batch_filter, **kwargs)
+                        else:
+                            with pubsub.deferred(), transaction.commit_on_success():
+                                stored = occurrence.store()
+                                if stored:
+                                    Notifications.fan_out(occurrence, filter, batch_size,
+                                                          batch_filter=batch_filter, **kwargs)
+                    mode = "push"
 
-                    if not sub.active:
-                        continue
+                metrics.increment("occurrences", mode=mode if stored else "duplicate")
+                return event
 
-                    if kwargs["actor"].username in sub.unfollow_actors.split(","):
-                        continue
+            metrics.increment("occurrences", mode="inactive")
+            if settings.METRICS_SUPPRESSIONS and metrics.get_sink() is not None:
+                metrics.increment("recipients_suppressed", Subscriptions.get(event=event).count(), reason="inactive")
 
-                    if not cls.do_filter(filter, subscription=sub, **kwargs):
-                        continue
+        except KeyError as e:
+            raise TypeError("The argument %s is missing" % e.message)
 
-                    rules = json.loads(sub.rules)
+    @classmethod
+    def add_many(cls, occurrences, batch_size=None, outbox=None):
+        """
+            register many occurrences, each one a dict with the arguments of
+            add (filters are not supported). The events are resolved once,
+            the subscriptions of all of them and their rules are read with
+            one query each and the rules evaluated in memory; the
+            notifications are written with bulk inserts of batch_size rows,
+            all in one transaction. The occurrences in fan-out on read mode
+            are committed before, in a transaction of their own. Return for each occurrence a dict with
+            the event, the stored occurrence (None if the event is inactive
+            or the occurrence a duplicate), the mode (push, pull, outbox,
+            inactive or duplicate) and the number of notifications created.
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+        if outbox is None:
+            outbox = settings.OUTBOX
 
-                    if kwargs["object_type"] in rules[0]:
-                        continue
+        items = []
+        events = {}
+        keys = set()
+        for kwargs in occurrences:
+            kwargs = dict(kwargs)
+            if kwargs.get("filter") is not None or kwargs.get("batch_filter") is not None:
+                raise TypeError("add_many does not support filters")
+            kwargs.setdefault("extra_data", {})
+            kwargs.setdefault("notify_channel", None)
+            kwargs.setdefault("auto_subscription", True)
+            try:
+                if kwargs["name"] not in events:
+                    events[kwargs["name"]] = cls.create_event(kwargs["name"],
+                                                              kwargs["description"],
+                                                              kwargs["category"],
+                                                              kwargs["auto_subscription"])
+                event = events[kwargs["name"]]
+                occurrence = Occurrences.build(event, kwargs) if event.active else None
+            except KeyError as e:
+                raise TypeError("The argument %s is missing" % e.message)
 
-                    if [kwargs["object_type"], kwargs["actor"].username] in rules[1]:
-                        continue
+            key = kwargs.get("idempotency_key")
+            if occurrence is not None and key is not None:
+                if key in keys:
+                    occurrence = None
+                else:
+                    occurrence.idempotency_key = key
+                    keys.add(key)
 
-                    if [kwargs["object_type"], kwargs["object_id"]] in rules[2]:
-                        continue
+            if occurrence is None:
+                mode = "inactive" if not event.active else "duplicate"
+            elif event.fan_out_on_read:
+                mode = "pull"
+                occurrence.pull = True
+                occurrence.status = Occurrences.DONE
+            elif outbox:
+                mode = "outbox"
+            else:
+                mode = "push"
+                occurrence.status = Occurrences.DONE
+            items.append({"event": event, "occurrence": occurrence, "mode": mode, "notifications": 0})
 
-                    if [kwargs["object_type"], kwargs["object_id"], kwargs["actor"].username] in rules[3]:
-                        continue
+        def drop_stored_keys():
+            #the keys already stored, with one query
+            keyed = [item for item in items
+                     if item["occurrence"] is not None and item["occurrence"].pk is None
+                     and item["occurrence"].idempotency_key is not None]
+            if not keyed:
+                return
+            existing = set(Occurrences.objects.filter(idempotency_key__in=[item["occurrence"].idempotency_key
+                                                                           for item in keyed])
+                                              .values_list("idempotency_key", flat=True))
+            for item in keyed:
+                if item["occurrence"].idempotency_key in existing:
+                    item["occurrence"] = None
+                    item["mode"] = "duplicate"
 
-                    Notifications.objects.create(user=sub.follower,
-                                                 event=event,
-                                                 actor=kwargs["actor"],
-                                                 object_type=kwargs["object_type"],
-                                                 object_id=kwargs["object_id"],
-                                                 extra_data=json.dumps(kwargs["extra_data"]),
-                                                 notify_channel=kwargs["notify_channel"],
-                                                 dispatch_time=int(time.time())+sub.period)
-                return event
+        def insert(group):
+            #store the occurrences of the items, inside a transaction
+            sid = transaction.savepoint()
+            try:
+                stored = Occurrences.bulk_create([item["occurrence"] for item in group
+                                                  if item["occurrence"] is not None], batch_size)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                #another producer stored some of the keys since they were read
+                transaction.savepoint_rollback(sid)
+                drop_stored_keys()
+                stored = Occurrences.bulk_create([item["occurrence"] for item in group
+                                                  if item["occurrence"] is not None], batch_size)
+            for item in group:
+                if item["occurrence"] is not None:
+                    item["occurrence"] = stored.pop(0)
 
-        except KeyError as e:
-            raise TypeError("The argument %s is missing" % e.message)
+        drop_stored_keys()
+
+        #the pulls move a cursor over the ids, the occurrences in fan-out on
+        #read mode are committed right away instead of after the fan-out
+        pulled = [item for item in items if item["mode"] == "pull"]
+        if pulled:
+            with transaction.commit_on_success():
+                insert(pulled)
+            pulled = [item["occurrence"].pk for item in pulled if item["occurrence"] is not None]
+            if pulled:
+                Occurrences.announce_pull(max(pulled))
+
+        with pubsub.deferred(), transaction.commit_on_success():
+            insert([item for item in items if item["mode"] != "pull"])
+            for item in items:
+                metrics.increment("occurrences", mode=item["mode"])
+
+            Notifications.fan_out_many([item for item in items if item["mode"] == "push"], batch_size)
+
+        return items
 
 
 class Subscriptions(models.Model):
@@ -144,13 +371,11 @@ class Subscriptions(models.Model):
     follower = models.ForeignKey(User, related_name='follower_user')
     #event name
     event = models.ForeignKey(Events)
-    #user that generate the event (all, for all users)
+    #legacy storage of the muted actors and rules, replaced by MuteRules,
+    #use Subscriptions.migrate_legacy_rules (manage.py notify_migrate_rules)
+    #to move the old values to the new table
     unfollow_actors = models.TextField(blank=True, null=False, default="")
-    #rules for filter notifications
-    #1 only by object type
-    # object type object id
-    # object type, object id, actor
-    rules = models.TextField(blank=False, null=False, default="[[],[],[],[]]")
+    rules = models.TextField(blank=False, null=False, default=LEGACY_RULES)
     #the minimum time for django_notify_events to the user this event
     period = models.BigIntegerField(default=0)
     #the notification channel of this event
@@ -159,7 +384,185 @@ class Subscriptions(models.Model):
 
     @classmethod
     def get(cls, *args, **kwargs):
-        return cls.objects.filter(active=True, *args, **kwargs)
+        queryset = cls.objects.filter(active=True, *args, **kwargs)
+        if "follower" in kwargs:
+            #the subscriptions of a user can be read from a replica, the
+            #fan-out reads them from the primary
+            queryset = routers.for_read(queryset, kwargs["follower"])
+        return queryset
+
+    @classmethod
+    def subscribe_all(cls, event, batch_size=None, progress=None):
+        """
+            subscribe every user to the event with the minimum period that the
+            user has registered for the category of the event. The users are
+            read by primary key ranges and the subscriptions written with bulk
+            inserts, progress (if given) is called after each batch with the
+            number of subscriptions created and the total number of users.
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        #get min period register for each user in this category
+        periods = dict(cls.objects.filter(event__category=event.category)
+                                  .values_list("follower")
+                                  .annotate(Min("period"))
+                                  .order_by())
+
+        total = User.objects.count() if progress is not None else None
+        users = User.objects.order_by("pk").values_list("pk", flat=True)
+        created = 0
+        last = 0
+        while True:
+            ids = list(users.filter(pk__gt=last)[:batch_size])
+            if not ids:
+                break
+
+            cls.objects.bulk_create([cls(follower_id=pk, event=event, period=periods.get(pk, 0))
+                                     for pk in ids], batch_size=batch_size)
+            created += len(ids)
+            last = ids[-1]
+
+            if progress is not None:
+                progress(created, total)
+
+        return created
+
+    @classmethod
+    def implicit(cls, event, exclude=None, after=0, instances=False):
+        """
+            iterate the ((follower_id, period), subscription) of the users
+            without a stored subscription to the event, ordered by follower,
+            with NOTIFY_EVENTS_SPARSE_SUBSCRIPTIONS they follow the auto
+            subscription events by default. The period is the minimum one the
+            user has in the category, the subscription is an unsaved instance
+            when instances is True and None otherwise.
+        """
+        periods = dict(cls.objects.filter(event__category=event.category)
+                                  .values_list("follower")
+                                  .annotate(Min("period"))
+                                  .order_by())
+
+        users = User.objects.exclude(pk__in=cls.objects.filter(event=event).values("follower")).order_by("pk")
+        if exclude is not None:
+            users = users.exclude(pk=exclude.pk)
+        if after:
+            users = users.filter(pk__gt=after)
+
+        if instances:
+            for user in users.iterator():
+                period = periods.get(user.pk, 0)
+                yield (user.pk, period), cls(follower=user, event=event, period=period)
+        else:
+            for pk in users.values_list("pk", flat=True).iterator():
+                yield (pk, periods.get(pk, 0)), None
+
+    @classmethod
+    def of_user(cls, user, events):
+        """
+            active subscriptions of the user to the events of the queryset,
+            with their event. The implicit ones of sparse subscriptions are
+            unsaved instances.
+        """
+        subs = list(cls.get(follower=user, event__in=events).select_related("event"))
+        if settings.SPARSE_SUBSCRIPTIONS:
+            stored = cls.objects.filter(follower=user).values("event")
+            implicit = list(events.filter(auto_subscription=True).exclude(pk__in=stored))
+            if implicit:
+                periods = dict(cls.objects.filter(follower=user)
+                                          .values_list("event__category")
+                                          .annotate(Min("period"))
+                                          .order_by())
+                subs.extend(cls(follower=user, event=event, period=periods.get(event.category, 0))
+                            for event in implicit)
+        return subs
+
+    @classmethod
+    def materialize(cls, follower, events):
+        """
+            with sparse subscriptions store the implicit subscriptions of the
+            follower to the events of the queryset, so they can be changed
+        """
+        if not settings.SPARSE_SUBSCRIPTIONS:
+            return
+
+        stored = cls.objects.filter(follower=follower).values("event")
+        missing = list(events.filter(auto_subscription=True).exclude(pk__in=stored).values_list("pk", "category"))
+        if not missing:
+            return
+
+        periods = dict(cls.objects.filter(follower=follower)
+                                  .values_list("event__category")
+                                  .annotate(Min("period"))
+                                  .order_by())
+        cls.objects.bulk_create([cls(follower=follower, event_id=pk, period=periods.get(category, 0))
+                                 for pk, category in missing], batch_size=settings.BATCH_SIZE)
+
+    @classmethod
+    def migrate_legacy_rules(cls, batch_size=None):
+        """
+            move the muted actors and rules stored in the legacy text fields
+            to MuteRules and reset the fields, return the number of rules
+            created. Safe to run more than once.
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        subs = cls.objects.exclude(unfollow_actors="", rules=LEGACY_RULES).order_by("pk")
+        created = 0
+        last = 0
+        while True:
+            chunk = list(subs.filter(pk__gt=last)[:batch_size])
+            if not chunk:
+                break
+            last = chunk[-1].pk
+
+            decoded = []
+            usernames = set()
+            for sub in chunk:
+                actors = [name for name in sub.unfollow_actors.split(",") if name]
+                rules = json.loads(sub.rules)
+                usernames.update(actors)
+                usernames.update(rule[1] for rule in rules[1])
+                usernames.update(rule[2] for rule in rules[3])
+                decoded.append((sub, actors, rules))
+
+            users = dict(User.objects.filter(username__in=usernames).values_list("username", "pk"))
+            existing = set(MuteRules.objects.filter(subscription__in=chunk)
+                                            .values_list("subscription", "kind", "object_type",
+                                                         "object_id", "actor"))
+
+            new_rules = []
+            for sub, actors, rules in decoded:
+                keys = [(MuteRules.ACTOR, "", "", users.get(name)) for name in actors]
+                keys += [(MuteRules.OBJECT_TYPE, object_type, "", None)
+                         for object_type in rules[0]]
+                keys += [(MuteRules.OBJECT_TYPE_ACTOR, object_type, "", users.get(name))
+                         for object_type, name in rules[1]]
+                keys += [(MuteRules.OBJECT, object_type, unicode(object_id), None)
+                         for object_type, object_id in rules[2]]
+                keys += [(MuteRules.OBJECT_ACTOR, object_type, unicode(object_id), users.get(name))
+                         for object_type, object_id, name in rules[3]]
+
+                for kind, object_type, object_id, actor_id in set(keys):
+                    #rules of users that do not exist anymore are dropped
+                    if kind in MuteRules.ACTOR_KINDS and actor_id is None:
+                        continue
+                    if (sub.pk, kind, object_type, object_id, actor_id) in existing:
+                        continue
+                    new_rules.append(MuteRules(subscription=sub,
+                                               kind=kind,
+                                               object_type=object_type,
+                                               object_id=object_id,
+                                               actor_id=actor_id))
+
+            with transaction.commit_on_success():
+                MuteRules.objects.bulk_create(new_rules, batch_size=batch_size)
+                cls.objects.filter(pk__in=[sub.pk for sub in chunk]).update(unfollow_actors="",
+                                                                             rules=LEGACY_RULES)
+            created += len(new_rules)
+
+        return created
 
     @classmethod
     def follow(cls, **kwargs):
@@ -170,46 +573,32 @@ class Subscriptions(models.Model):
         follower = kwargs["follower"]
         category = kwargs.get("category", None)
 
+        #the occurrences in fan-out on read mode stored while the follower
+        #did not follow them are skipped before following them again
+        Notifications.pull(follower)
+
         if actor is not None and object_type is None and object_id is None and category is None:
             if event is None:
-                for sub in Subscriptions.objects.filter(follower=follower):
-                    unfollow_actors = set(sub.unfollow_actors.split(","))
-                    if actor.username in unfollow_actors:
-                        unfollow_actors.remove(actor.username)
-
-                    sub.unfollow_actors = ",".join(unfollow_actors)
-                    sub.save()
+                MuteRules.objects.filter(subscription__follower=follower,
+                                         kind=MuteRules.ACTOR,
+                                         actor=actor).delete()
             else:
+                cls.materialize(follower, Events.objects.filter(pk=event.pk))
                 sub = Subscriptions.objects.get(follower=follower, event=event)
-                unfollow_actors = set(sub.unfollow_actors.split(","))
-                if actor.username in unfollow_actors:
-                    unfollow_actors.remove(actor.username)
-
-                sub.unfollow_actors = ",".join(unfollow_actors)
-                sub.save()
+                MuteRules.objects.filter(subscription=sub, kind=MuteRules.ACTOR, actor=actor).delete()
 
         elif actor is None and object_type is not None and object_id is None and category is None:
             if event is None:
-                for sub in Subscriptions.objects.filter(follower=follower):
-                    rules = json.loads(sub.rules)
-                    rules[0] = set(rules[0])
-                    if object_type in rules[0]:
-                        rules[0].remove(object_type)
-                    rules[0] = list(rules[0])
-                    sub.rules = json.dumps(rules)
-                    sub.save()
+                MuteRules.objects.filter(subscription__follower=follower,
+                                         kind=MuteRules.OBJECT_TYPE,
+                                         object_type=object_type).delete()
 
             else:
+                cls.materialize(follower, Events.objects.filter(pk=event.pk))
                 sub = Subscriptions.objects.get(follower=follower, event=event)
-                rules = json.loads(sub.rules)
-                rules[0] = set(rules[0])
-
-                if object_type in rules[0]:
-                    rules[0].remove(object_type)
-
-                rules[0] = list(rules[0])
-                sub.rules = json.dumps(rules)
-                sub.save()
+                MuteRules.objects.filter(subscription=sub,
+                                         kind=MuteRules.OBJECT_TYPE,
+                                         object_type=object_type).delete()
 
         elif actor is None and object_type is None and object_id is None and category is None:
             if event is None:
@@ -222,6 +611,8 @@ class Subscriptions(models.Model):
         else:
             raise TypeError("Bad Arguments")
 
+        routers.stick(follower)
+
     @classmethod
     def unfollow(cls, **kwargs):
         actor = kwargs.get("actor", None)
@@ -233,73 +624,1234 @@ class Subscriptions(models.Model):
 
         if actor is not None and object_type is None and object_id is None and category is None:
             if event is None:
-                for sub in Subscriptions.objects.filter(follower=follower):
-                    unfollow_actors = sub.unfollow_actors.split(",")
-                    unfollow_actors.append(actor.username)
-                    sub.unfollow_actors = ",".join(set(unfollow_actors))
-                    sub.save()
-                    Notifications.get(user=follower, actor=actor).update(read=True)
+                cls.materialize(follower, Events.objects.all())
+                MuteRules.mute(cls.objects.filter(follower=follower), MuteRules.ACTOR, actor=actor)
+                Notifications.mark_read(Notifications.get(user=follower, actor=actor))
             else:
+                cls.materialize(follower, Events.objects.filter(pk=event.pk))
                 sub = Subscriptions.objects.get(follower=follower, event=event)
-                unfollow_actors = sub.unfollow_actors.split(",")
-                unfollow_actors.append(actor.username)
-                sub.unfollow_actors = ",".join(set(unfollow_actors))
-                sub.save()
-                Notifications.get(user=follower, event=event, actor=actor).update(read=True)
+                MuteRules.objects.get_or_create(subscription=sub, kind=MuteRules.ACTOR, actor=actor)
+                Notifications.mark_read(Notifications.get(user=follower, event=event, actor=actor))
 
         elif actor is None and object_type is not None and object_id is None and category is None:
             if event is None:
-                for sub in Subscriptions.objects.filter(follower=follower):
-                    rules = json.loads(sub.rules)
-                    rules[0] = set(rules[0])
-                    rules[0].add(object_type)
-                    rules[0] = list(rules[0])
-                    sub.rules = json.dumps(rules)
-                    sub.save()
-                Notifications.get(user=follower, object_type=object_type).update(read=True)
+                cls.materialize(follower, Events.objects.all())
+                MuteRules.mute(cls.objects.filter(follower=follower), MuteRules.OBJECT_TYPE, object_type=object_type)
+                Notifications.mark_read(Notifications.get(user=follower, object_type=object_type))
 
             else:
+                cls.materialize(follower, Events.objects.filter(pk=event.pk))
                 sub = Subscriptions.objects.get(follower=follower, event=event)
-                rules = json.loads(sub.rules)
-                rules[0] = set(rules[0])
-                rules[0].add(object_type)
-                rules[0] = list(rules[0])
-                sub.rules = json.dumps(rules)
-                sub.save()
-                Notifications.get(user=follower, event=event, object_type=object_type).update(read=True)
+                MuteRules.objects.get_or_create(subscription=sub,
+                                                kind=MuteRules.OBJECT_TYPE,
+                                                object_type=object_type)
+                Notifications.mark_read(Notifications.get(user=follower, event=event, object_type=object_type))
 
         elif actor is None and object_type is None and object_id is None and category is None:
             if event is None:
+                cls.materialize(follower, Events.objects.all())
                 cls.objects.filter(follower=follower).update(active=False)
-                Notifications.get(user=follower).update(read=True)
+                Notifications.mark_read(Notifications.get(user=follower))
             else:
+                cls.materialize(follower, Events.objects.filter(pk=event.pk))
                 cls.objects.filter(follower=follower, event=event).update(active=False)
-                Notifications.get(user=follower, event=event).update(read=True)
+                Notifications.mark_read(Notifications.get(user=follower, event=event))
 
         elif actor is None and object_type is None and object_id is None and category is not None and event is None:
             events = Events.objects.filter(category=category)
+            cls.materialize(follower, events)
             cls.objects.filter(follower=follower, event__in=events).update(active=False)
-            Notifications.get(user=follower, event__in=events).update(read=True)
+            Notifications.mark_read(Notifications.get(user=follower, event__in=list(events)))
 
         else:
             raise TypeError("Bad Arguments")
 
+        routers.stick(follower)
 
-class Notifications(models.Model):
+
+class MuteRules(models.Model):
     """
-        store all the notifications
+        store the rules that mute the notifications of a subscription
     """
 
-    user = models.ForeignKey(User, related_name='follower_notification')
+    #notifications of the actor
+    ACTOR = 0
+    #notifications about an object type
+    OBJECT_TYPE = 1
+    #notifications of the actor about an object type
+    OBJECT_TYPE_ACTOR = 2
+    #notifications about an object
+    OBJECT = 3
+    #notifications of the actor about an object
+    OBJECT_ACTOR = 4
+
+    KINDS = ((ACTOR, "actor"),
+             (OBJECT_TYPE, "object type"),
+             (OBJECT_TYPE_ACTOR, "object type and actor"),
+             (OBJECT, "object"),
+             (OBJECT_ACTOR, "object and actor"))
+
+    ACTOR_KINDS = (ACTOR, OBJECT_TYPE_ACTOR, OBJECT_ACTOR)
+
+    subscription = models.ForeignKey(Subscriptions, related_name="mute_rules")
+    kind = models.PositiveSmallIntegerField(choices=KINDS)
+    #empty when the kind does not use the field
+    object_type = models.CharField(max_length=20, blank=True, default="")
+    object_id = models.CharField(max_length=20, blank=True, default="")
+    actor = models.ForeignKey(User, null=True, blank=True, related_name="+")
+
+    class Meta:
+        unique_together = (("subscription", "kind", "object_type", "object_id", "actor"),)
+        #lookups of the rules matching an occurrence
+        index_together = (("kind", "object_type", "object_id", "actor"),
+                          ("kind", "actor", "object_type"))
+
+    def matches(self, actor_id, object_type, object_id):
+        """
+            True if the rule mutes an occurrence
+        """
+        if self.kind in self.ACTOR_KINDS and self.actor_id != actor_id:
+            return False
+        if self.kind != self.ACTOR and self.object_type != object_type:
+            return False
+        if self.kind in (self.OBJECT, self.OBJECT_ACTOR) and self.object_id != object_id:
+            return False
+        return True
+
+    @classmethod
+    def mute(cls, subscriptions, kind, **fields):
+        """
+            add the rule to the subscriptions of the queryset that do not have
+            it yet, with a constant number of queries
+        """
+        existing = cls.objects.filter(subscription__in=subscriptions, kind=kind, **fields)
+        ids = list(subscriptions.exclude(pk__in=existing.values("subscription")).values_list("pk", flat=True))
+        if not ids:
+            return
+
+        rules = [cls(subscription_id=pk, kind=kind, **fields) for pk in ids]
+        sid = transaction.savepoint()
+        try:
+            cls.objects.bulk_create(rules, batch_size=settings.BATCH_SIZE)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            #some of them were added in the meantime by another process
+            transaction.savepoint_rollback(sid)
+            for rule in rules:
+                cls.objects.get_or_create(subscription_id=rule.subscription_id, kind=kind, **fields)
+
+    @classmethod
+    def matching(cls, event, actor, object_type, object_id):
+        """
+            rules of the subscriptions of the event that mute an occurrence
+        """
+        return cls.objects.filter(Q(kind=cls.ACTOR, actor=actor) |
+                                  Q(kind=cls.OBJECT_TYPE, object_type=object_type) |
+                                  Q(kind=cls.OBJECT_TYPE_ACTOR, object_type=object_type, actor=actor) |
+                                  Q(kind=cls.OBJECT, object_type=object_type, object_id=object_id) |
+                                  Q(kind=cls.OBJECT_ACTOR, object_type=object_type, object_id=object_id,
+                                    actor=actor),
+                                  subscription__event=event)
+
+
+class LeaseLost(Exception):
+    """
+        the claim of a worker over an occurrence expired and was taken by
+        another worker
+    """
+
+
+class Occurrences(models.Model):
+    """
+        store the occurrences of the events waiting for the fan-out (outbox)
+    """
+
+    PENDING = 0
+    PROCESSING = 1
+    DONE = 2
+    FAILED = 3
+
+    #cache key of the id of the newest occurrence in fan-out on read mode
+    NEWEST_PULL_KEY = "django_notify_events:pull:newest"
+
+    STATUS = ((PENDING, "pending"),
+              (PROCESSING, "processing"),
+              (DONE, "done"),
+              (FAILED, "failed"))
+
     event = models.ForeignKey(Events)
-    actor = models.ForeignKey(User,  related_name='actor_notification')
+    actor = models.ForeignKey(User, related_name="+")
     object_type = models.CharField(max_length=20, null=False, blank=False)
     object_id = models.CharField(max_length=20, null=False, blank=False)
     extra_data = models.TextField(default='{}')
     notify_channel = models.CharField(max_length=20, null=True)
+    #time of the occurrence, the periods of the subscriptions count from it
+    created = models.BigIntegerField(default=0)
+    status = models.PositiveSmallIntegerField(choices=STATUS, default=PENDING)
+    #worker that claimed the occurrence and until when the claim is valid
+    worker = models.CharField(max_length=60, blank=True, default="")
+    lease = models.BigIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    #last follower notified, the fan-out of a reclaimed occurrence resumes
+    #after it
+    last_follower = models.IntegerField(default=0)
+    #occurrence of an event in fan-out on read mode
+    pull = models.BooleanField(default=False)
+    #key given by the producer, an occurrence with the key of a stored one is
+    #ignored. The keys are cleared after NOTIFY_EVENTS_IDEMPOTENCY_KEY_TTL
+    idempotency_key = models.CharField(max_length=100, null=True, unique=True)
+
+    class Meta:
+        index_together = (("status", "lease"),
+                          ("pull", "event"))
+
+    @classmethod
+    def claim(cls, worker, limit, lease=None):
+        """
+            claim up to limit pending occurrences (or occurrences whose claim
+            expired) for the worker, oldest first. Safe to call from many
+            processes, each occurrence is claimed by only one of them. The
+            expired claims without attempts left are marked as failed.
+        """
+        if lease is None:
+            lease = settings.OUTBOX_LEASE
+
+        now = int(time.time())
+        #a worker killed during the last attempt can not mark it as failed
+        abandoned = cls.objects.filter(status=cls.PROCESSING,
+                                       lease__lt=now,
+                                       attempts__gte=settings.OUTBOX_MAX_ATTEMPTS)
+        abandoned_ids = list(abandoned.order_by("pk").values_list("pk", flat=True)[:limit])
+        if abandoned_ids and abandoned.filter(pk__in=abandoned_ids).update(status=cls.FAILED):
+            logger.error("occurrences %s failed after %d attempts",
+                         ", ".join(str(pk) for pk in abandoned_ids), settings.OUTBOX_MAX_ATTEMPTS)
+
+        claimable = cls.objects.filter(Q(status=cls.PENDING) | Q(status=cls.PROCESSING, lease__lt=now),
+                                       attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+        ids = list(claimable.order_by("pk").values_list("pk", flat=True)[:limit])
+        if not ids:
+            return []
+
+        #the conditions are checked again by the update, if another worker
+        #claimed some of the rows in the meantime they are not updated
+        claimable.filter(pk__in=ids).update(status=cls.PROCESSING,
+                                            worker=worker,
+                                            lease=now+lease,
+                                            attempts=F("attempts")+1)
+
+        return list(cls.objects.filter(pk__in=ids, worker=worker, status=cls.PROCESSING)
+                               .select_related("event", "actor")
+                               .order_by("pk"))
+
+    def process(self, batch_size=None, lease=None):
+        """
+            fan-out a claimed occurrence, each batch of notifications is
+            committed with the position of the fan-out so a reclaimed
+            occurrence resumes after the last committed batch
+        """
+        if lease is None:
+            lease = settings.OUTBOX_LEASE
+
+        def checkpoint(last_follower):
+            if not self._claimed().update(last_follower=last_follower, lease=int(time.time())+lease):
+                raise LeaseLost("the occurrence %s was claimed by another worker" % self.pk)
+            self.last_follower = last_follower
+
+        try:
+            #the event could have been deactivated after the occurrence
+            if self.event.active:
+                Notifications.fan_out(self, batch_size=batch_size, checkpoint=checkpoint)
+        except LeaseLost:
+            raise
+        except Exception:
+            if self.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                self._claimed().update(status=self.FAILED)
+            raise
+
+        self._claimed().update(status=self.DONE)
+        self.status = self.DONE
+
+    def _claimed(self):
+        return Occurrences.objects.filter(pk=self.pk, worker=self.worker, status=self.PROCESSING)
+
+    @classmethod
+    def announce_pull(cls, pk):
+        """
+            tell the pulls, and the clients waiting through pubsub, that an
+            occurrence in fan-out on read mode was stored
+        """
+        cache.set(cls.NEWEST_PULL_KEY, pk, settings.PULL_CHECK_INTERVAL)
+        pubsub.publish_pull()
+
+    @classmethod
+    def newest_pull(cls, cached=True):
+        """
+            id of the newest occurrence in fan-out on read mode that can be
+            pulled, 0 if there is none. The cached value can be behind by
+            NOTIFY_EVENTS_PULL_CHECK_INTERVAL seconds when occurrences are
+            stored concurrently, or ahead by NOTIFY_EVENTS_PULL_DELAY seconds
+        """
+        newest = cache.get(cls.NEWEST_PULL_KEY) if cached else None
+        if newest is None:
+            pending = cls.objects.filter(pull=True)
+            if settings.PULL_DELAY:
+                pending = pending.filter(created__lte=int(time.time()) - settings.PULL_DELAY)
+            newest = pending.aggregate(newest=Max("pk"))["newest"] or 0
+            cache.set(cls.NEWEST_PULL_KEY, newest, settings.PULL_CHECK_INTERVAL)
+        return newest
+
+    def store(self):
+        """
+            save the occurrence, return False if another one with the same
+            idempotency key was stored first
+        """
+        if self.idempotency_key is None:
+            self.save()
+            return True
+
+        sid = transaction.savepoint()
+        try:
+            self.save()
+            transaction.savepoint_commit(sid)
+            return True
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return False
+
+    @classmethod
+    def expire_keys(cls, ttl=None, batch_size=None):
+        """
+            clear the idempotency keys of the occurrences stored more than
+            ttl (default NOTIFY_EVENTS_IDEMPOTENCY_KEY_TTL) seconds ago, in
+            batches of batch_size. Return the number of keys cleared.
+        """
+        if ttl is None:
+            ttl = settings.IDEMPOTENCY_KEY_TTL
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        expired = cls.objects.filter(idempotency_key__isnull=False, created__lt=int(time.time()) - ttl)
+        cleared = 0
+        while True:
+            ids = list(expired.order_by("pk").values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                return cleared
+            cleared += cls.objects.filter(pk__in=ids).update(idempotency_key=None)
+
+    @classmethod
+    def build(cls, event, kwargs):
+        """
+            unsaved occurrence of the event with the arguments of Events.add
+        """
+        return cls(event=event,
+                   actor=kwargs["actor"],
+                   object_type=kwargs["object_type"],
+                   object_id=kwargs["object_id"],
+                   extra_data=json.dumps(kwargs["extra_data"]),
+                   notify_channel=kwargs["notify_channel"],
+                   created=int(time.time()))
+
+    @classmethod
+    def bulk_create(cls, occurrences, batch_size=None):
+        """
+            insert the occurrences and return them with their primary key, in
+            the same order. The inserted rows are found back by a token
+            stored in worker, which the outbox overwrites when it claims them.
+        """
+        if not occurrences:
+            return []
+
+        token = "bulk:%s" % uuid.uuid4().hex
+        for occurrence in occurrences:
+            occurrence.worker = token
+        cls.objects.bulk_create(occurrences, batch_size=batch_size)
+
+        stored = list(cls.objects.filter(worker=token).select_related("event", "actor").order_by("pk"))
+        cls.objects.filter(worker=token).update(worker="")
+        for occurrence in stored:
+            occurrence.worker = ""
+        return stored
+
+    @classmethod
+    def purge(cls, days=None, batch_size=None):
+        """
+            delete the occurrences already fanned out (or failed) more than
+            days (default NOTIFY_EVENTS_RETENTION_DAYS) ago that are not the
+            payload of a stored notification. The occurrences in fan-out on
+            read mode are deleted too, they are not pulled after the
+            retention.
+        """
+        if days is None:
+            days = settings.RETENTION_DAYS
+        if days is None:
+            return 0
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        cutoff = int(time.time()) - days * 86400
+        processed = cls.objects.filter(status__in=(cls.DONE, cls.FAILED), created__lt=cutoff)
+        deleted = 0
+        last = 0
+        while True:
+            ids = list(processed.filter(pk__gt=last).order_by("pk").values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            last = ids[-1]
+
+            #the payload of the notifications still stored is kept
+            for notifications in Notifications.shards():
+                referenced = set(notifications.filter(occurrence__in=ids).values_list("occurrence", flat=True))
+                ids = [pk for pk in ids if pk not in referenced]
+            if ids:
+                cls.objects.filter(pk__in=ids).delete()
+                deleted += len(ids)
+
+
+class Notifications(models.Model):
+    """
+        store all the notifications
+    """
+
+    UNDELIVERED = 0
+    CLAIMED = 1
+    DELIVERED = 2
+    FAILED = 3
+
+    DELIVERY = ((UNDELIVERED, "undelivered"),
+                (CLAIMED, "claimed"),
+                (DELIVERED, "delivered"),
+                (FAILED, "failed"))
+
+    #deleted by delete_related, django can not follow them to the shards
+    user = models.ForeignKey(User, related_name='follower_notification', on_delete=models.DO_NOTHING)
+    event = models.ForeignKey(Events, on_delete=models.DO_NOTHING)
+    actor = models.ForeignKey(User,  related_name='actor_notification', on_delete=models.DO_NOTHING)
+    object_type = models.CharField(max_length=20, null=False, blank=False)
+    object_id = models.CharField(max_length=20, null=False, blank=False)
+    #the occurrence stores the payload (extra_data) once for all the
+    #followers. The purge keeps the occurrences of the notifications stored,
+    #which can be in other databases, so the database does not cascade
+    occurrence = models.ForeignKey(Occurrences, null=True, related_name="+", on_delete=models.DO_NOTHING)
+    #payload of the notifications written before it was shared
+    own_extra_data = models.TextField(default='{}', db_column="extra_data")
+    notify_channel = models.CharField(max_length=20, null=True)
     read = models.BooleanField(default=False)
     dispatch_time = models.BigIntegerField(default=0)
+    #number of occurrences merged in the notification and their latest
+    #actors (json list of ids, most recent first) for events with coalesce
+    count = models.PositiveIntegerField(default=1)
+    actors = models.TextField(default="[]")
+    #delivery through the notify channel (see dispatch.Dispatcher), worker
+    #that claimed the notification and until when
+    delivery = models.PositiveSmallIntegerField(choices=DELIVERY, default=UNDELIVERED)
+    worker = models.CharField(max_length=60, blank=True, default="")
+    lease = models.BigIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        #inbox reads (Notifications.get) and unread notifications marked as
+        #read by unfollow, the partial index of the unread rows is created
+        #after syncdb by indexes.create_partial_indexes
+        index_together = (("user", "read", "dispatch_time"),
+                          ("user", "event", "read"),
+                          ("user", "actor", "read"),
+                          ("user", "object_type", "read"),
+                          #notifications waiting for the dispatcher
+                          ("delivery", "dispatch_time"))
+
+    @property
+    def extra_data(self):
+        """
+            json payload of the notification, read from its occurrence
+        """
+        if self.occurrence_id is not None:
+            return self.occurrence.extra_data
+        return self.own_extra_data
+
+    @extra_data.setter
+    def extra_data(self, value):
+        self.own_extra_data = value
+
+    @property
+    def data(self):
+        """
+            extra_data decoded, the json is parsed the first time it is read
+        """
+        if not hasattr(self, "_data"):
+            self._data = json.loads(self.extra_data)
+        return self._data
+
+    @property
+    def actor_ids(self):
+        return json.loads(self.actors) or [self.actor_id]
 
     @classmethod
     def get(cls, *args, **kwargs):
-        return cls.objects.filter(read=False, dispatch_time__lte=int(time.time()), *args, **kwargs)
\ No newline at end of file
+        if "user" in kwargs:
+            cls.pull(kwargs["user"])
+            queryset = cls.shard(kwargs["user"])
+        elif routers.sharded():
+            raise TypeError("the user is required to read sharded notifications")
+        else:
+            queryset = cls.objects.all()
+
+        queryset = queryset.filter(read=False, dispatch_time__lte=int(time.time()), *args, **kwargs)
+        if "user" in kwargs:
+            queryset = routers.for_read(queryset, kwargs["user"])
+        return queryset
+
+    @classmethod
+    def shard(cls, user):
+        """
+            notifications of the database that stores the ones of the user
+        """
+        if routers.sharded():
+            return cls.objects.using(routers.shard_for(user))
+        return cls.objects.all()
+
+    @classmethod
+    def shards(cls):
+        """
+            notifications of each database
+        """
+        if routers.sharded():
+            return [cls.objects.using(alias) for alias in routers.shards()]
+        return [cls.objects.all()]
+
+    @classmethod
+    def by_shard(cls, notifications):
+        """
+            list of (queryset of the database, notifications to store there)
+        """
+        if routers.sharded():
+            return [(cls.objects.using(alias), group) for alias, group in routers.group(notifications).items()]
+        return [(cls.objects.all(), notifications)]
+
+    @classmethod
+    def bulk_create(cls, notifications, batch_size=None):
+        """
+            insert the notifications in the database of each user
+        """
+        for queryset, shard_notifications in cls.by_shard(notifications):
+            queryset.bulk_create(shard_notifications, batch_size=batch_size)
+
+    @classmethod
+    def delete_related(cls, sender, instance, **kwargs):
+        """
+            delete the notifications of a deleted user or event in every
+            shard, the collector of django only looks in the database of the
+            deleted object, and discount the unread ones
+        """
+        if sender is Events:
+            lookup = Q(event=instance.pk)
+        else:
+            lookup = Q(user=instance.pk) | Q(actor=instance.pk)
+        for notifications in cls.shards():
+            doomed = notifications.filter(lookup)
+            with transaction.commit_on_success(using=doomed.db), transaction.commit_on_success():
+                #locked, a concurrent mark_read does not discount them too
+                unread = list(doomed.filter(read=False).select_for_update().values_list("user", "event"))
+                doomed.delete()
+                if unread:
+                    categories = Events.categories(event_id for user_id, event_id in unread)
+                    UnreadCounters.subtract([(user_id, categories[event_id], 1) for user_id, event_id in unread])
+
+    @classmethod
+    def with_related(cls, queryset, *fields):
+        """
+            load the related objects of the notifications, joined by the same
+            query unless they live in another database
+        """
+        if routers.sharded():
+            return queryset.prefetch_related(*fields)
+        return queryset.select_related(*fields)
+
+    @classmethod
+    def of_category(cls, queryset, category):
+        if routers.sharded():
+            return queryset.filter(event__in=list(Events.objects.filter(category=category).values_list("pk", flat=True)))
+        return queryset.filter(event__category=category)
+
+    @classmethod
+    def claim(cls, worker, limit, lease=None):
+        """
+            claim up to limit unread and undelivered notifications whose
+            dispatch time arrived (or whose claim expired) for the worker, in
+            order of dispatch time (within each shard). Safe to call from
+            many processes. The expired claims without attempts left are
+            marked as failed.
+        """
+        if lease is None:
+            lease = settings.DISPATCH_LEASE
+
+        now = int(time.time())
+        claimed = []
+        for notifications in cls.shards():
+            if len(claimed) >= limit:
+                break
+
+            #a dispatcher killed during the last attempt can not mark it as
+            #failed
+            abandoned = notifications.filter(delivery=cls.CLAIMED,
+                                             lease__lt=now,
+                                             attempts__gte=settings.DISPATCH_MAX_ATTEMPTS)
+            abandoned_ids = list(abandoned.order_by("pk").values_list("pk", flat=True)[:limit])
+            if abandoned_ids and abandoned.filter(pk__in=abandoned_ids).update(delivery=cls.FAILED):
+                logger.error("notifications %s failed after %d attempts",
+                             ", ".join(str(pk) for pk in abandoned_ids), settings.DISPATCH_MAX_ATTEMPTS)
+
+            claimable = notifications.filter(Q(delivery=cls.UNDELIVERED) | Q(delivery=cls.CLAIMED, lease__lt=now),
+                                             read=False,
+                                             dispatch_time__lte=now,
+                                             attempts__lt=settings.DISPATCH_MAX_ATTEMPTS)
+            ids = list(claimable.order_by("dispatch_time", "pk").values_list("pk", flat=True)[:limit - len(claimed)])
+            if not ids:
+                continue
+
+            #the conditions are checked again by the update, if another worker
+            #claimed some of the rows in the meantime they are not updated
+            claimable.filter(pk__in=ids).update(delivery=cls.CLAIMED,
+                                                worker=worker,
+                                                lease=now+lease,
+                                                attempts=F("attempts")+1)
+
+            claimed.extend(cls.with_related(notifications.filter(pk__in=ids, worker=worker, delivery=cls.CLAIMED),
+                                            "user", "event", "actor", "occurrence").order_by("dispatch_time", "pk"))
+        return claimed
+
+    @classmethod
+    def _claimed(cls, worker, notifications):
+        """
+            querysets of the notifications still claimed by the worker, one
+            per database
+        """
+        by_db = {}
+        for notification in notifications:
+            by_db.setdefault(notification._state.db, []).append(notification.pk)
+        return [cls.objects.using(db).filter(pk__in=ids, worker=worker, delivery=cls.CLAIMED)
+                for db, ids in by_db.items()]
+
+    @classmethod
+    def mark_delivered(cls, worker, notifications):
+        return sum(claimed.update(delivery=cls.DELIVERED) for claimed in cls._claimed(worker, notifications))
+
+    @classmethod
+    def mark_failed(cls, worker, notifications, retry_delay=None):
+        """
+            the notifications are claimed again after retry_delay seconds,
+            or given up after NOTIFY_EVENTS_DISPATCH_MAX_ATTEMPTS
+        """
+        if retry_delay is None:
+            retry_delay = settings.DISPATCH_RETRY_DELAY
+
+        for claimed in cls._claimed(worker, notifications):
+            claimed.filter(attempts__gte=settings.DISPATCH_MAX_ATTEMPTS).update(delivery=cls.FAILED)
+            claimed.update(lease=int(time.time())+retry_delay)
+
+    @classmethod
+    def mark_read(cls, queryset):
+        """
+            mark as read the notifications of the queryset and update the
+            unread counters, return the number of notifications marked
+        """
+        queryset = routers.for_write(queryset).filter(read=False)
+        #the events could be in another database, no join
+        pairs = list(queryset.values_list("user", "event").distinct().order_by())
+        if not pairs:
+            return 0
+        categories = Events.categories(event_id for user_id, event_id in pairs)
+        groups = {}
+        for user_id, event_id in pairs:
+            groups.setdefault((user_id, categories[event_id]), []).append(event_id)
+
+        #the counters lose the rows each update marked, the ones marked by a
+        #concurrent call are not counted twice
+        marked = 0
+        with transaction.commit_on_success(using=queryset.db), transaction.commit_on_success():
+            counts = []
+            for (user_id, category), event_ids in groups.items():
+                count = queryset.filter(user=user_id, event__in=event_ids).update(read=True)
+                if count:
+                    counts.append((user_id, category, count))
+                    marked += count
+            UnreadCounters.subtract(counts)
+        routers.stick(*set(user_id for user_id, category in groups))
+        return marked
+
+    @classmethod
+    def unread_count(cls, user, category=""):
+        """
+            number of unread notifications of the user (of a category) already
+            dispatched, read from the counters
+        """
+        cls.pull(user)
+        return UnreadCounters.get(user, category)
+
+    @classmethod
+    def purge(cls, days=None, max_per_user=None, batch_size=None, archive=None):
+        """
+            delete the read notifications dispatched more than days ago and
+            the read notifications of each user beyond the max_per_user
+            newest ones (defaults NOTIFY_EVENTS_RETENTION_DAYS and
+            NOTIFY_EVENTS_RETENTION_MAX_PER_USER, None keeps them). Unread
+            notifications are never deleted so the counters stay right.
+            archive is called with each batch before it is deleted. Return
+            the number of notifications deleted.
+        """
+        if days is None:
+            days = settings.RETENTION_DAYS
+        if max_per_user is None:
+            max_per_user = settings.RETENTION_MAX_PER_USER
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        def rows(queryset):
+            #serialize needs the event of each notification
+            return cls.with_related(queryset, "event", "occurrence") if archive is not None else queryset
+
+        deleted = 0
+        for notifications in cls.shards():
+            if days is not None:
+                cutoff = int(time.time()) - days * 86400
+                expired = notifications.filter(read=True, dispatch_time__lt=cutoff)
+                deleted += delete_in_batches(rows(expired), batch_size, archive)
+
+            if max_per_user is None:
+                continue
+
+            users = [row["user"] for row in notifications.values("user")
+                                                         .annotate(total=Count("id"))
+                                                         .filter(total__gt=max_per_user)
+                                                         .order_by()]
+            for user_id in users:
+                older = notifications.filter(user=user_id, read=True)
+                if max_per_user > 0:
+                    #the oldest notification kept
+                    dispatch_time, pk = (notifications.filter(user=user_id)
+                                                      .order_by("-dispatch_time", "-pk")
+                                                      .values_list("dispatch_time", "pk")[max_per_user - 1])
+                    older = older.filter(Q(dispatch_time__lt=dispatch_time) | Q(dispatch_time=dispatch_time, pk__lt=pk))
+                deleted += delete_in_batches(rows(older), batch_size, archive)
+
+        return deleted
+
+    @classmethod
+    def pull(cls, user, batch_size=None):
+        """
+            write in the inbox of the user the occurrences of the events in
+            fan-out on read mode stored since the last pull, honoring the
+            subscriptions of the user like the fan-out does. The occurrences
+            are read in chunks of batch_size, each one committed with the
+            cursor, and the cursor moves past the occurrences of the events
+            the user does not follow so they are not delivered after a new
+            follow. The occurrences newer than NOTIFY_EVENTS_PULL_DELAY
+            seconds are left for the next pull: an occurrence committed more
+            than that delay after one with a higher id is never pulled.
+            Return the number of notifications created.
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+        if not isinstance(user, User):
+            user = User.objects.get(pk=user)
+
+        cursor, created = PullCursors.objects.get_or_create(user=user)
+        if Occurrences.newest_pull() <= cursor.last_occurrence:
+            return 0
+        #the cached id is only a hint, the cursor moves up to the real one
+        newest = Occurrences.newest_pull(cached=False)
+        if newest <= cursor.last_occurrence:
+            return 0
+
+        subs = dict((sub.event_id, sub) for sub in Subscriptions.of_user(user, Events.objects.filter(fan_out_on_read=True)))
+        events = dict((event_id, sub.event.category) for event_id, sub in subs.items())
+        rules = {}
+        if subs:
+            for rule in MuteRules.objects.filter(subscription__in=[sub.pk for sub in subs.values() if sub.pk]):
+                rules.setdefault(rule.subscription_id, []).append(rule)
+
+        #the occurrences written after newest wait for the next pull, the
+        #ones out of the retention could be deleted by a purge meanwhile
+        since = calendar.timegm(user.date_joined.utctimetuple())
+        if settings.RETENTION_DAYS is not None:
+            since = max(since, int(time.time()) - settings.RETENTION_DAYS * 86400)
+        followed = (Occurrences.objects.filter(pull=True,
+                                               event__in=subs.keys(),
+                                               pk__lte=newest,
+                                               created__gte=since)
+                                       .exclude(actor=user)
+                                       .order_by("pk"))
+
+        total = 0
+        last = cursor.last_occurrence
+        now = int(time.time())
+        while last < newest:
+            occurrences = list(followed.filter(pk__gt=last)[:batch_size]) if subs else []
+            end = occurrences[-1].pk if len(occurrences) >= batch_size else newest
+
+            notifications = []
+            for occurrence in occurrences:
+                sub = subs[occurrence.event_id]
+                if sub.pk and any(rule.matches(occurrence.actor_id, occurrence.object_type, occurrence.object_id)
+                                  for rule in rules.get(sub.pk, ())):
+                    continue
+
+                #not before the pull, the readers of the inbox that saw the
+                #newer notifications already would skip it
+                notifications.append(cls(user=user,
+                                         event_id=occurrence.event_id,
+                                         actor_id=occurrence.actor_id,
+                                         object_type=occurrence.object_type,
+                                         object_id=occurrence.object_id,
+                                         occurrence_id=occurrence.pk,
+                                         notify_channel=occurrence.notify_channel,
+                                         dispatch_time=max(occurrence.created+sub.period, now)))
+
+            with transaction.commit_on_success():
+                #move the cursor first, if another request pulled the same
+                #occurrences in the meantime nothing is written
+                if not PullCursors.objects.filter(pk=cursor.pk, last_occurrence=last).update(last_occurrence=end):
+                    return total
+                if notifications:
+                    cls.shard(user).bulk_create(notifications, batch_size=batch_size)
+                    routers.stick(user)
+
+                    categories = {}
+                    for notification in notifications:
+                        categories.setdefault(events[notification.event_id], []).append(notification)
+                    for category, category_notifications in categories.items():
+                        UnreadCounters.add(category, category_notifications)
+
+            total += len(notifications)
+            last = end
+
+        return total
+
+    @classmethod
+    def fan_out(cls, occurrence, filter=None, batch_size=None, checkpoint=None, batch_filter=None, **kwargs):
+        """
+            create the notifications of an occurrence of the event for all
+            the followers, the subscriptions are fetched in one query and the
+            rows are written with bulk inserts of batch_size rows, so the
+            number of queries does not depend on the number of followers
+            (one select plus one insert per batch), the muted subscriptions
+            are excluded by the same select. With checkpoint the followers are
+            visited in order starting after occurrence.last_follower and each
+            batch is committed with a call to checkpoint(last_follower).
+            With sparse subscriptions the implicit followers are read by a
+            second select. filter is called for each subscription, batch_filter once for
+            each batch with the list of follower ids and must return the ids
+            allowed. The followers whose notification is visible right away
+            are woken through pubsub. Return the number of notifications
+            created.
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        event = occurrence.event
+        actor = occurrence.actor
+
+        #the muted subscriptions are removed by the database (anti-join)
+        muted = MuteRules.matching(event, actor, occurrence.object_type, occurrence.object_id)
+        subs = Subscriptions.get(event=event).exclude(follower=actor).exclude(pk__in=muted.values("subscription"))
+        if settings.METRICS_SUPPRESSIONS and not occurrence.last_follower and metrics.get_sink() is not None:
+            cls._count_suppressed(occurrence, muted)
+        filtered = [0, 0.0]
+        if checkpoint is not None:
+            subs = subs.filter(follower__gt=occurrence.last_follower).order_by("follower")
+
+        if filter is None:
+            candidates = ((row, None) for row in subs.values_list("follower", "period").iterator())
+        else:
+            #the filter receives the subscription, load the followers in
+            #the same query
+            candidates = (((sub.follower_id, sub.period), sub)
+                          for sub in subs.select_related("follower").iterator())
+
+        if settings.SPARSE_SUBSCRIPTIONS and event.auto_subscription:
+            implicit = Subscriptions.implicit(event,
+                                              exclude=actor,
+                                              after=occurrence.last_follower if checkpoint is not None else 0,
+                                              instances=filter is not None)
+            if checkpoint is not None:
+                #both are ordered by follower
+                candidates = heapq.merge(candidates, implicit)
+            else:
+                candidates = itertools.chain(candidates, implicit)
+
+        def write(batch):
+            if event.coalesce:
+                with metrics.timed("fan_out", phase="coalesce"):
+                    pending = len(batch)
+                    batch = cls.coalesce(occurrence, batch)
+                metrics.increment("notifications_coalesced", pending - len(batch))
+            if batch:
+                with metrics.timed("fan_out", phase="insert"):
+                    cls.bulk_create(batch, batch_size)
+                    UnreadCounters.add(event.category, batch)
+                metrics.increment("notifications_written", len(batch))
+                pubsub.publish(batch)
+
+        def flush(batch, last_follower):
+            metrics.increment("recipients_considered", len(batch) + filtered[0])
+            metrics.increment("recipients_suppressed", filtered[0], reason="filter")
+            filtered[0] = 0
+            if filtered[1]:
+                metrics.timing("fan_out", filtered[1], phase="filter")
+                filtered[1] = 0.0
+
+            if batch_filter is not None:
+                start = time.time()
+                allowed = Events.do_batch_filter(batch_filter, [row.user_id for row in batch], **kwargs)
+                metrics.timing("fan_out", time.time() - start, phase="filter")
+                considered = len(batch)
+                batch = [row for row in batch if row.user_id in allowed]
+                metrics.increment("recipients_suppressed", considered - len(batch), reason="filter")
+
+            if checkpoint is None:
+                write(batch)
+            else:
+                with pubsub.deferred(), transaction.commit_on_success():
+                    write(batch)
+                    checkpoint(last_follower)
+            return len(batch)
+
+        actors = json.dumps([actor.pk]) if event.coalesce else "[]"
+
+        batch = []
+        created = 0
+        for (follower_id, period), sub in candidates:
+            if sub is not None:
+                start = time.time()
+                allowed = Events.do_filter(filter, subscription=sub, **kwargs)
+                filtered[1] += time.time() - start
+                if not allowed:
+                    filtered[0] += 1
+                    continue
+
+            batch.append(cls(user_id=follower_id,
+                             event=event,
+                             actor=actor,
+                             object_type=occurrence.object_type,
+                             object_id=occurrence.object_id,
+                             occurrence_id=occurrence.pk,
+                             notify_channel=occurrence.notify_channel,
+                             dispatch_time=occurrence.created+period,
+                             actors=actors))
+
+            if len(batch) >= batch_size:
+                created += flush(batch, follower_id)
+                batch = []
+
+        if batch or filtered[0]:
+            created += flush(batch, batch[-1].user_id if batch else occurrence.last_follower)
+
+        return created
+
+    @classmethod
+    def _count_suppressed(cls, occurrence, muted):
+        """
+            send to the metrics the followers left out of the fan-out by the
+            database, it costs four COUNT queries so it is only done with
+            NOTIFY_EVENTS_METRICS_SUPPRESSIONS
+        """
+        subs = Subscriptions.objects.filter(event=occurrence.event_id)
+        active = subs.filter(active=True)
+        others = active.exclude(follower=occurrence.actor_id)
+        muted_actor = muted.filter(kind=MuteRules.ACTOR).values("subscription")
+        counts = {"inactive": subs.filter(active=False).count(),
+                  "self": active.filter(follower=occurrence.actor_id).count(),
+                  "muted_actor": others.filter(pk__in=muted_actor).count(),
+                  "rule": others.exclude(pk__in=muted_actor).filter(pk__in=muted.values("subscription")).count()}
+
+        for reason, count in counts.items():
+            metrics.increment("recipients_suppressed", count, reason=reason)
+        metrics.increment("recipients_considered", sum(counts.values()))
+
+    @classmethod
+    def fan_out_many(cls, items, batch_size=None):
+        """
+            fan-out of the items of Events.add_many, the subscriptions of all
+            the events and their rules are read once and the rules evaluated
+            in memory. The number of notifications created is stored in each
+            item. With sparse subscriptions each occurrence is fanned out by
+            fan_out.
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+        if not items:
+            return
+
+        if settings.SPARSE_SUBSCRIPTIONS:
+            for item in items:
+                item["notifications"] = cls.fan_out(item["occurrence"], batch_size=batch_size)
+            return
+
+        event_ids = set(item["event"].pk for item in items)
+        followers = {}
+        for sub_id, follower_id, event_id, period in (Subscriptions.objects.filter(event__in=event_ids, active=True)
+                                                                           .values_list("pk", "follower", "event", "period")
+                                                                           .iterator()):
+            followers.setdefault(event_id, []).append((sub_id, follower_id, period))
+
+        rules = {}
+        for rule in MuteRules.objects.filter(subscription__event__in=event_ids, subscription__active=True):
+            rules.setdefault(rule.subscription_id, []).append(rule)
+
+        pending = []
+
+        def write(notifications):
+            categories = {}
+            for notification in notifications:
+                categories.setdefault(notification.event.category, []).append(notification)
+            cls.bulk_create(notifications, batch_size)
+            for category, category_notifications in categories.items():
+                UnreadCounters.add(category, category_notifications)
+            metrics.increment("notifications_written", len(notifications))
+            pubsub.publish(notifications)
+
+        for item in items:
+            occurrence = item["occurrence"]
+            event = item["event"]
+            actors = json.dumps([occurrence.actor_id]) if event.coalesce else "[]"
+
+            batch = []
+            for sub_id, follower_id, period in followers.get(event.pk, ()):
+                if follower_id == occurrence.actor_id:
+                    continue
+                if any(rule.matches(occurrence.actor_id, occurrence.object_type, occurrence.object_id)
+                       for rule in rules.get(sub_id, ())):
+                    continue
+
+                batch.append(cls(user_id=follower_id,
+                                 event=event,
+                                 actor_id=occurrence.actor_id,
+                                 object_type=occurrence.object_type,
+                                 object_id=occurrence.object_id,
+                                 occurrence_id=occurrence.pk,
+                                 notify_channel=occurrence.notify_channel,
+                                 dispatch_time=occurrence.created+period,
+                                 actors=actors))
+
+            if event.coalesce:
+                #the notifications written before can be merged
+                if pending:
+                    write(pending)
+                    pending = []
+                batch = cls.coalesce(occurrence, batch)
+                if batch:
+                    write(batch)
+            else:
+                pending.extend(batch)
+                if len(pending) >= batch_size:
+                    write(pending)
+                    pending = []
+            item["notifications"] = len(batch)
+
+        if pending:
+            write(pending)
+
+    @classmethod
+    def coalesce(cls, occurrence, notifications):
+        """
+            merge the occurrence in the notifications about the same object
+            of the users that are still waiting for their dispatch time, return
+            the notifications of the users without one
+        """
+        merged = set()
+        for queryset, shard_notifications in cls.by_shard(notifications):
+            pending = (queryset.filter(user__in=[notification.user_id for notification in shard_notifications],
+                                       event=occurrence.event_id,
+                                       object_type=occurrence.object_type,
+                                       object_id=occurrence.object_id,
+                                       read=False,
+                                       dispatch_time__gt=occurrence.created)
+                               .values_list("pk", "user", "actors"))
+
+            groups = {}
+            for pk, user_id, actors in pending:
+                if user_id not in merged:
+                    merged.add(user_id)
+                    groups.setdefault(actors, []).append(pk)
+
+            #the notifications with the same actors get the same new list
+            for actors, pks in groups.items():
+                actors = [occurrence.actor_id] + [pk for pk in json.loads(actors) if pk != occurrence.actor_id]
+                queryset.filter(pk__in=pks).update(count=F("count")+1,
+                                                   actor=occurrence.actor_id,
+                                                   actors=json.dumps(actors[:settings.COALESCE_MAX_ACTORS]),
+                                                   occurrence=occurrence.pk)
+
+        return [notification for notification in notifications if notification.user_id not in merged]
+
+
+class UnreadCounters(models.Model):
+    """
+        store the number of unread notifications of each user, in total
+        (empty category) and by category of the event
+    """
+
+    user = models.ForeignKey(User, related_name="+")
+    category = models.CharField(max_length=60, blank=True, default="")
+    count = models.IntegerField(default=0)
+    #latest dispatch_time of the counted notifications, until then some of
+    #them could be still waiting for their dispatch time
+    pending_until = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("user", "category"),)
+
+    @classmethod
+    def get(cls, user, category=""):
+        try:
+            counter = routers.for_read(cls.objects.all(), user).get(user=user, category=category)
+        except ObjectDoesNotExist:
+            return 0
+
+        count = counter.count
+        now = int(time.time())
+        if counter.pending_until > now:
+            #only the notifications not dispatched yet are counted here
+            pending = routers.for_read(Notifications.shard(user), user).filter(user=user,
+                                                                              read=False,
+                                                                              dispatch_time__gt=now)
+            if category:
+                pending = Notifications.of_category(pending, category)
+            count -= pending.count()
+        return max(count, 0)
+
+    @classmethod
+    def add(cls, category, notifications):
+        """
+            count new notifications of events of the category
+        """
+        now = int(time.time())
+        counts = {}
+        pending = {}
+        for notification in notifications:
+            counts[notification.user_id] = counts.get(notification.user_id, 0) + 1
+            if notification.dispatch_time > now:
+                pending[notification.user_id] = max(pending.get(notification.user_id, 0),
+                                                    notification.dispatch_time)
+
+        for key in ("", category):
+            cls._create_missing(counts.keys(), key)
+
+            for count, users in cls._group(counts).items():
+                cls.objects.filter(user__in=users, category=key).update(count=F("count")+count)
+
+            for dispatch_time, users in cls._group(pending).items():
+                cls.objects.filter(user__in=users,
+                                   category=key,
+                                   pending_until__lt=dispatch_time).update(pending_until=dispatch_time)
+
+    @classmethod
+    def subtract(cls, counts):
+        """
+            discount notifications read, counts is a list of (user id,
+            category, number of notifications)
+        """
+        by_category = {}
+        for user_id, category, count in counts:
+            for key in ("", category):
+                users = by_category.setdefault(key, {})
+                users[user_id] = users.get(user_id, 0) + count
+
+        for category, users in by_category.items():
+            for count, group in cls._group(users).items():
+                cls.objects.filter(user__in=group, category=category).update(count=F("count")-count)
+
+    @classmethod
+    def reconcile(cls, batch_size=None):
+        """
+            compute again the counters from the notifications, return the
+            number of counters that were wrong
+        """
+        if batch_size is None:
+            batch_size = settings.BATCH_SIZE
+
+        users = User.objects.order_by("pk").values_list("pk", flat=True)
+        repaired = 0
+        last = 0
+        while True:
+            ids = list(users.filter(pk__gt=last)[:batch_size])
+            if not ids:
+                break
+            last = ids[-1]
+
+            expected = {}
+            rows = []
+            for notifications in Notifications.shards():
+                rows.extend(notifications.filter(user__in=ids, read=False)
+                                         .values("user", "event")
+                                         .annotate(count=Count("id"), dispatch_time=Max("dispatch_time"))
+                                         .order_by())
+            categories = Events.categories(row["event"] for row in rows)
+            for row in rows:
+                for key in ("", categories[row["event"]]):
+                    total, pending_until = expected.get((row["user"], key), (0, 0))
+                    expected[(row["user"], key)] = (total + row["count"],
+                                                    max(pending_until, row["dispatch_time"]))
+
+            with transaction.commit_on_success():
+                current = cls.objects.select_for_update().filter(user__in=ids)
+                current = dict(((counter.user_id, counter.category), counter.count) for counter in current)
+                repaired += len([key for key in set(current) | set(expected)
+                                 if current.get(key, 0) != expected.get(key, (0, 0))[0]])
+
+                cls.objects.filter(user__in=ids).delete()
+                cls.objects.bulk_create([cls(user_id=user_id,
+                                             category=category,
+                                             count=count,
+                                             pending_until=pending_until)
+                                         for (user_id, category), (count, pending_until) in expected.items()],
+                                        batch_size=batch_size)
+
+        return repaired
+
+    @classmethod
+    def _create_missing(cls, users, category):
+        existing = set(cls.objects.filter(user__in=users, category=category).values_list("user", flat=True))
+        missing = [cls(user_id=user_id, category=category) for user_id in users if user_id not in existing]
+        if not missing:
+            return
+
+        sid = transaction.savepoint()
+        try:
+            cls.objects.bulk_create(missing)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            #created in the meantime by another process
+            transaction.savepoint_rollback(sid)
+            for counter in missing:
+                cls.objects.get_or_create(user_id=counter.user_id, category=category)
+
+    @staticmethod
+    def _group(values):
+        #users by value, to update the users with the same value at once
+        groups = {}
+        for user_id, value in values.items():
+            groups.setdefault(value, []).append(user_id)
+        return groups
+
+
+class PullCursors(models.Model):
+    """
+        store the last occurrence in fan-out on read mode written to the
+        inbox of each user
+    """
+
+    user = models.ForeignKey(User, unique=True, related_name="+")
+    last_occurrence = models.IntegerField(default=0)
+
+
+#any change of an event invalidates the registry
+post_save.connect(registry.invalidate, sender=Events, dispatch_uid="django_notify_events.registry.save")
+post_delete.connect(registry.invalidate, sender=Events, dispatch_uid="django_notify_events.registry.delete")
+
+pre_delete.connect(Notifications.delete_related, sender=User, dispatch_uid="django_notify_events.notifications.user")
+pre_delete.connect(Notifications.delete_related, sender=Events, dispatch_uid="django_notify_events.notifications.event")
+category_changed.connect(registry.invalidate, sender=Events, dispatch_uid="django_notify_events.registry.category")
+
+post_syncdb.connect(create_partial_indexes_after_syncdb,
+                    sender=sys.modules[__name__],
+                    dispatch_uid="django_notify_events.indexes")
@@ -0,0 +1,168 @@
+"""
+    wake the clients waiting for the notifications of a user (views.poll_view
+    and views.stream_view). The fan-out publishes to the followers whose
+    notifications are visible right away, the dispatcher to the ones whose
+    dispatch time arrived later. The occurrences in fan-out on read mode have
+    no known recipients, they wake every client (EVERYONE), which pulls them
+    once they are NOTIFY_EVENTS_PULL_DELAY seconds old. The messages only
+    tell that something new may be there, the views read the notifications
+    from the database.
+
+    The broker of NOTIFY_EVENTS_PUBSUB_BROKER (dotted path of a class, None to
+    turn it off) implements:
+
+    publish(user_ids, message), user_ids can contain EVERYONE to reach every
+    subscription
+    subscribe(user_id), returning an object with get(timeout), the list of
+    messages received (empty after timeout seconds without any), and close()
+
+    The default InMemoryBroker only reaches the clients connected to the same
+    process, a broker (redis, ...) is needed with more than one process.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django_notify_events.conf import instance
+
+
+#channel of the messages for every user
+EVERYONE = "*"
+
+
+class BaseBroker(object):
+
+    def publish(self, user_ids, message):
+        raise NotImplementedError
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+
+class InMemorySubscription(object):
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        try:
+            messages = [self.queue.get(timeout=max(timeout, 0))]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker(BaseBroker):
+    """
+        broker of the clients connected to this process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def publish(self, user_ids, message):
+        with self.lock:
+            if EVERYONE in user_ids:
+                waiting = list(self.subscriptions.values())
+            else:
+                waiting = [self.subscriptions[user_id] for user_id in user_ids if user_id in self.subscriptions]
+        for subscriptions in waiting:
+            for subscription in list(subscriptions):
+                subscription.queue.put(message)
+
+    def subscribe(self, user_id):
+        subscription = InMemorySubscription(self, user_id)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+
+def get_broker():
+    return instance("PUBSUB_BROKER")
+
+
+_deferred = threading.local()
+
+
+def publish(notifications, now=None):
+    """
+        wake the users of the notifications visible at now (default the
+        current time)
+    """
+    broker = get_broker()
+    if broker is None or not notifications:
+        return
+
+    if now is None:
+        now = int(time.time())
+    by_event = {}
+    for notification in notifications:
+        if notification.dispatch_time <= now:
+            by_event.setdefault(notification.event_id, set()).add(notification.user_id)
+
+    for event_id, user_ids in by_event.items():
+        _send(broker, user_ids, {"event": event_id})
+
+
+def publish_pull():
+    """
+        wake every user, occurrences in fan-out on read mode were stored
+    """
+    broker = get_broker()
+    if broker is not None:
+        _send(broker, [EVERYONE], {"pull": True})
+
+
+def _send(broker, user_ids, message):
+    pending = getattr(_deferred, "pending", None)
+    if pending is not None:
+        pending.append((user_ids, message))
+    else:
+        broker.publish(user_ids, message)
+
+
+@contextmanager
+def deferred():
+    """
+        hold the messages published inside the block until it ends without
+        error, so the clients are not woken before the transaction of the
+        notifications is committed
+    """
+    if getattr(_deferred, "pending", None) is not None:
+        #nested, the outer block publishes
+        yield
+        return
+
+    _deferred.pending = []
+    try:
+        yield
+        pending = _deferred.pending
+    finally:
+        _deferred.pending = None
+
+    broker = get_broker()
+    if broker is not None:
+        for user_ids, message in pending:
+            broker.publish(user_ids, message)
@@ -0,0 +1,21 @@
+from django.db.models.query import QuerySet
+
+
+class ReplicaQuerySet(QuerySet):
+    """
+        queryset read from a replica, its writes (update, delete...) go to
+        the primary database
+    """
+
+    primary = None
+
+    @property
+    def db(self):
+        if self._for_write and self.primary is not None:
+            return self.primary
+        return super(ReplicaQuerySet, self).db
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault("primary", self.primary)
+        return super(ReplicaQuerySet, self)._clone(klass, setup, **kwargs)
+
@@ -0,0 +1,61 @@
+import copy
+import time
+import uuid
+
+from django.core.cache import cache
+
+from django_notify_events.conf import settings
+
+
+class EventRegistry(object):
+    """
+        process local cache of the events by name. Changes made in this
+        process invalidate it right away, the other processes are told
+        through a version stored in the django cache which is checked every
+        NOTIFY_EVENTS_REGISTRY_CHECK_INTERVAL seconds.
+    """
+
+    version_key = "django_notify_events:registry:version"
+
+    def __init__(self):
+        self._events = {}
+        self._version = None
+        self._checked = 0
+
+    def get(self, name):
+        """
+            return a copy of the cached event or None
+        """
+        self._check_version()
+        event = self._events.get(name)
+        if event is None:
+            return None
+        return copy.copy(event)
+
+    def add(self, event):
+        self._check_version()
+        self._events[event.name] = copy.copy(event)
+
+    def invalidate(self, *args, **kwargs):
+        """
+            clear the registry of every process, it can be connected to the
+            signals of the model
+        """
+        self._events = {}
+        self._version = uuid.uuid4().hex
+        self._checked = time.time()
+        cache.set(self.version_key, self._version, None)
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._checked < settings.REGISTRY_CHECK_INTERVAL:
+            return
+
+        self._checked = now
+        version = cache.get(self.version_key)
+        if version != self._version:
+            self._events = {}
+            self._version = version
+
+
+registry = EventRegistry()
@@ -0,0 +1,133 @@
+"""
+    spread the notifications over the databases of NOTIFY_EVENTS_SHARDS, the
+    notifications of a user are stored in shards[user_id % len(shards)]:
+
+    DATABASE_ROUTERS = ["django_notify_events.routers.ShardRouter"]
+    NOTIFY_EVENTS_SHARDS = ["notifications_0", "notifications_1"]
+
+    The rest of the tables (users, events, subscriptions, counters...) stay
+    in the default database, so the queries of the notifications never join
+    them.
+
+    The reads of the inbox, counters and subscriptions of a user go to a
+    replica of NOTIFY_EVENTS_REPLICAS, except for a few seconds after the
+    user changed them:
+
+    NOTIFY_EVENTS_REPLICAS = {"default": ["replica_0", "replica_1"]}
+"""
+import random
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from django_notify_events.conf import settings
+
+
+def sharded():
+    return bool(settings.SHARDS)
+
+
+def shards():
+    """
+        aliases of the databases that store notifications
+    """
+    return list(settings.SHARDS or [DEFAULT_DB_ALIAS])
+
+
+def shard_for(user):
+    aliases = shards()
+    return aliases[getattr(user, "pk", user) % len(aliases)]
+
+
+def group(notifications):
+    """
+        split the notifications by the shard of their user
+    """
+    groups = {}
+    for notification in notifications:
+        groups.setdefault(shard_for(notification.user_id), []).append(notification)
+    return groups
+
+
+def _is_notifications(model):
+    return model._meta.app_label == "django_notify_events" and model._meta.object_name == "Notifications"
+
+
+class ShardRouter(object):
+    """
+        database router of the shards, it does nothing while
+        NOTIFY_EVENTS_SHARDS is not set
+    """
+
+    def db_for_read(self, model, **hints):
+        if not sharded():
+            return None
+
+        instance = hints.get("instance")
+        if _is_notifications(model):
+            #the hint can also be the object assigned to a foreign key
+            if instance is not None and _is_notifications(type(instance)) and instance.user_id is not None:
+                return shard_for(instance.user_id)
+            return None
+
+        if instance is not None and _is_notifications(type(instance)):
+            #the related objects of a notification are in the default database
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if sharded() and (_is_notifications(type(obj1)) or _is_notifications(type(obj2))):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if not sharded():
+            return None
+        if _is_notifications(model):
+            return db in settings.SHARDS
+        if db != DEFAULT_DB_ALIAS and db in settings.SHARDS:
+            return False
+        return None
+
+
+def _sticky_key(user):
+    return "django_notify_events:sticky:%s" % getattr(user, "pk", user)
+
+
+def stick(*users):
+    """
+        read the data of the users from the primary databases for
+        NOTIFY_EVENTS_REPLICA_STICKY_SECONDS, after they changed it
+    """
+    if settings.REPLICAS:
+        cache.set_many(dict((_sticky_key(user), True) for user in users), settings.REPLICA_STICKY_SECONDS)
+
+
+def for_read(queryset, user):
+    """
+        the queryset read from a replica of its database
+        (NOTIFY_EVENTS_REPLICAS), unless the user changed something recently
+    """
+    if not settings.REPLICAS:
+        return queryset
+
+    primary = queryset.db
+    replicas = settings.REPLICAS.get(primary)
+    if not replicas or cache.get(_sticky_key(user)):
+        return queryset
+
+    #django.db imports the routers, the querysets can not be imported before
+    from django_notify_events.query import ReplicaQuerySet
+    return queryset._clone(klass=ReplicaQuerySet, primary=primary).using(random.choice(replicas))
+
+
+def for_write(queryset):
+    """
+        the queryset in its primary database
+    """
+    primary = getattr(queryset, "primary", None)
+    if primary is not None:
+        return queryset.using(primary)
+    return queryset
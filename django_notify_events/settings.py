@@ -17,9 +17,25 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+    },
+    # notification shards of the tests, see NOTIFY_EVENTS_SHARDS
+    'shard_0': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory_shard_0',
+    },
+    'shard_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory_shard_1',
+    },
+    # replica of the tests, it is not replicated so it shows where the reads go
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory_replica',
+    },
 }
 
+DATABASE_ROUTERS = ['django_notify_events.routers.ShardRouter']
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.4/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
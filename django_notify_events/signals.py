@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+#sent once after the active flag of the events of a category changed in bulk,
+#event_ids are the events that were updated
+category_changed = Signal(providing_args=["category", "active", "event_ids"])
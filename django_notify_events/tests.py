@@ -1,11 +1,49 @@
 from django.utils import unittest
-from models import Events, Subscriptions, Notifications
+from django.test.client import Client
+from registry import registry
+import indexes
+from inbox import Inbox, encode_cursor
+from dispatch import Dispatcher
+import backends
+import metrics
+import pubsub
+import signals
+from models import Events, Subscriptions, MuteRules, Occurrences, Notifications, UnreadCounters, LeaseLost, \
+    PullCursors
 from django.contrib.auth.models import User
+import datetime
+import gzip
 import json
+import os
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from django.core.exceptions import ObjectDoesNotExist
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F, Q
+from django.test.utils import override_settings
 import time
 
 
+class QueryCounter(object):
+    """
+        count the queries executed inside the with block
+    """
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *args):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.use_debug_cursor
+
+
 class NotifyTestCases(unittest.TestCase):
 
     @classmethod
@@ -718,4 +756,1150 @@ class NotifyTestCases(unittest.TestCase):
 
 
         self.assertEqual(len(Notifications.get(user=self.follower, event=event1)), 2)
-        self.assertEqual(len(Notifications.get(user=self.follower, event=event2)), 2)
\ No newline at end of file
+        self.assertEqual(len(Notifications.get(user=self.follower, event=event2)), 2)
+
+    def test_fan_out_query_count(self):
+        def add(name):
+            event_dict = {"name": name,
+                          "category": "c_fan_out",
+                          "description": "is random",
+                          "object_type": "blog_post",
+                          "object_id": "00",
+                          "actor": self.actor}
+
+            #the first notification of a user also creates the counters
+            Events.add(**event_dict)
+            with QueryCounter() as counter:
+                Events.add(**event_dict)
+            return counter.count
+
+        few = add("fan_out_few")
+
+        for i in range(20):
+            User.objects.create_user("fan_out_%s" % i, "fan_out_%s@test.com" % i, "pass")
+
+        many = add("fan_out_many")
+
+        self.assertEqual(few, many)
+        self.assertEqual(Notifications.objects.filter(event__name="fan_out_many").count(),
+                         2 * (User.objects.count() - 1))
+
+    def test_fan_out_batch_size(self):
+        event = Events.create_event("fan_out_batch", "is random", "c_fan_out")
+        Events.add(name="fan_out_batch",
+                   description="is random",
+                   category="c_fan_out",
+                   object_type="blog_post",
+                   object_id="00",
+                   actor=self.actor,
+                   batch_size=2)
+
+        self.assertEqual(Notifications.objects.filter(event=event).count(),
+                         Subscriptions.get(event=event).count() - 1)
+
+    def test_fan_out_rules(self):
+        event = Events.create_event("fan_out_rules", "is random", "c_fan_out")
+        MuteRules.objects.create(subscription=Subscriptions.objects.get(follower=self.follower, event=event),
+                                 kind=MuteRules.OBJECT,
+                                 object_type="blog_post",
+                                 object_id="01")
+        MuteRules.objects.create(subscription=Subscriptions.objects.get(follower=self.follower2, event=event),
+                                 kind=MuteRules.OBJECT_ACTOR,
+                                 object_type="blog_post",
+                                 object_id="00",
+                                 actor=self.actor)
+
+        event_dict = {"name": "fan_out_rules",
+                      "category": "c_fan_out",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+
+        Events.add(**event_dict)
+        event_dict["object_id"] = "01"
+        Events.add(**event_dict)
+
+        self.assertEqual(len(Notifications.objects.filter(user=self.follower, event=event, object_id="00")), 1)
+        self.assertEqual(len(Notifications.objects.filter(user=self.follower, event=event, object_id="01")), 0)
+        self.assertEqual(len(Notifications.objects.filter(user=self.follower2, event=event, object_id="00")), 0)
+        self.assertEqual(len(Notifications.objects.filter(user=self.follower2, event=event, object_id="01")), 1)
+
+    def test_create_event_query_count(self):
+        def create(name):
+            with QueryCounter() as counter:
+                Events.create_event(name, "is random", "c_create_event_query_count")
+            return counter.count
+
+        few = create("create_event_few")
+
+        for i in range(20):
+            User.objects.create_user("create_event_%s" % i, "create_event_%s@test.com" % i, "pass")
+
+        many = create("create_event_many")
+
+        self.assertEqual(few, many)
+        self.assertEqual(Subscriptions.objects.filter(event__name="create_event_many").count(),
+                         User.objects.count())
+
+    def test_create_event_progress(self):
+        calls = []
+        event = Events.create_event("create_event_progress", "is random", "c_random",
+                                    progress=lambda created, total: calls.append((created, total)))
+        total = User.objects.count()
+        event.delete()
+
+        Subscriptions.subscribe_all(Events.objects.create(name="create_event_progress",
+                                                          description="is random",
+                                                          category="c_random"),
+                                    batch_size=2,
+                                    progress=lambda created, total: calls.append((created, total)))
+
+        self.assertEqual(calls[0], (total, total))
+        self.assertEqual(calls[-1], (total, total))
+        self.assertEqual(len(calls), 1 + (total + 1) // 2)
+
+    def test_subscribe_all_min_period(self):
+        event1 = Events.create_event("subscribe_all_1", "is random", "c_subscribe_all_min_period")
+        event2 = Events.create_event("subscribe_all_2", "is random", "c_subscribe_all_min_period")
+        Subscriptions.objects.filter(follower=self.follower, event=event1).update(period=50)
+        Subscriptions.objects.filter(follower=self.follower, event=event2).update(period=2)
+
+        event3 = Events.create_event("subscribe_all_3", "is random", "c_subscribe_all_min_period")
+
+        self.assertEqual(Subscriptions.objects.get(follower=self.follower, event=event3).period, 2)
+        self.assertEqual(Subscriptions.objects.get(follower=self.follower2, event=event3).period, 0)
+
+    def test_migrate_legacy_rules(self):
+        event = Events.create_event("migrate_legacy_rules", "is random", "c_random")
+        Subscriptions.objects.filter(follower=self.follower, event=event).update(
+            unfollow_actors=",actor,unknown",
+            rules=json.dumps([["blog_post"], [["photo", "actor"]], [["blog_post", 1]], [["photo", "02", "actor"]]]))
+
+        Subscriptions.migrate_legacy_rules()
+        Subscriptions.migrate_legacy_rules()
+
+        sub = Subscriptions.objects.get(follower=self.follower, event=event)
+        self.assertEqual(sub.unfollow_actors, "")
+        self.assertEqual(sub.rules, "[[],[],[],[]]")
+        self.assertEqual(sorted(sub.mute_rules.values_list("kind", "object_type", "object_id", "actor")),
+                         [(MuteRules.ACTOR, "", "", self.actor.pk),
+                          (MuteRules.OBJECT_TYPE, "blog_post", "", None),
+                          (MuteRules.OBJECT_TYPE_ACTOR, "photo", "", self.actor.pk),
+                          (MuteRules.OBJECT, "blog_post", "1", None),
+                          (MuteRules.OBJECT_ACTOR, "photo", "02", self.actor.pk)])
+
+    def test_outbox(self):
+        event_dict = {"name": "outbox",
+                      "category": "c_outbox",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor,
+                      "outbox": True}
+
+        event = Events.add(**event_dict)
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 0)
+
+        occurrence = Occurrences.objects.get(event=event)
+        self.assertEqual(occurrence.status, Occurrences.PENDING)
+
+        claimed = Occurrences.claim("worker1", 100)
+        self.assertTrue(occurrence in claimed)
+        self.assertEqual(Occurrences.claim("worker2", 100), [])
+
+        for occurrence in claimed:
+            occurrence.process()
+
+        self.assertEqual(Occurrences.objects.get(event=event).status, Occurrences.DONE)
+        self.assertEqual(Notifications.objects.filter(event=event).count(),
+                         Subscriptions.get(event=event).count() - 1)
+
+    def test_outbox_crash_recovery(self):
+        event_dict = {"name": "outbox_crash_recovery",
+                      "category": "c_outbox",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor,
+                      "outbox": True}
+
+        event = Events.add(**event_dict)
+
+        #a dead worker claimed the occurrence and notified the first follower
+        occurrence = Occurrences.claim("dead_worker", 100)[0]
+        occurrence.process(batch_size=1)
+        notified = Notifications.objects.filter(event=event).count()
+        Notifications.objects.filter(event=event).exclude(user=self.follower).delete()
+        Occurrences.objects.filter(pk=occurrence.pk).update(status=Occurrences.PROCESSING,
+                                                            lease=0,
+                                                            last_follower=self.follower.pk)
+
+        occurrence = Occurrences.claim("worker", 100)[0]
+        self.assertEqual(occurrence.worker, "worker")
+        occurrence.process(batch_size=1)
+
+        self.assertEqual(Notifications.objects.filter(event=event).count(), notified)
+        self.assertEqual(Notifications.objects.filter(event=event, user=self.follower).count(), 1)
+
+        #a worker killed during the last attempt
+        Occurrences.objects.filter(pk=occurrence.pk).update(status=Occurrences.PROCESSING, lease=0, attempts=2)
+        with override_settings(NOTIFY_EVENTS_OUTBOX_MAX_ATTEMPTS=2):
+            claimed = Occurrences.claim("worker", 100)
+        self.assertFalse(occurrence.pk in [claimed_occurrence.pk for claimed_occurrence in claimed])
+        self.assertEqual(Occurrences.objects.get(pk=occurrence.pk).status, Occurrences.FAILED)
+
+    def test_outbox_lease_lost(self):
+        event = Events.add(name="outbox_lease_lost",
+                           category="c_outbox",
+                           description="is random",
+                           object_type="blog_post",
+                           object_id="00",
+                           actor=self.actor,
+                           outbox=True)
+
+        occurrence = Occurrences.claim("slow_worker", 100)[0]
+        Occurrences.objects.filter(pk=occurrence.pk).update(lease=0)
+        Occurrences.claim("worker", 100)
+
+        self.assertRaises(LeaseLost, occurrence.process, batch_size=1)
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 0)
+        self.assertEqual(Occurrences.objects.get(pk=occurrence.pk).worker, "worker")
+
+    @override_settings(NOTIFY_EVENTS_PULL_DELAY=0)
+    def test_fan_out_on_read(self):
+        event_dict = {"name": "fan_out_on_read",
+                      "category": "c_fan_out_on_read",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+
+        event = Events.create_event(event_dict["name"], event_dict["description"], event_dict["category"])
+        event.fan_out_on_read = True
+        event.save()
+        Subscriptions.objects.filter(follower=self.follower2, event=event).update(period=3600)
+        Events.create_event(event_dict["name"], event_dict["description"], event_dict["category"])
+
+        with QueryCounter() as counter:
+            Events.add(**event_dict)
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 0)
+        self.assertEqual(Occurrences.objects.filter(event=event, pull=True).count(), 1)
+
+        self.assertEqual(len(Notifications.get(user=self.follower, event=event)), 1)
+        self.assertEqual(len(Notifications.get(user=self.follower, event=event)), 1)
+        self.assertEqual(len(Notifications.get(user=self.follower2, event=event)), 0)
+        self.assertEqual(len(Notifications.objects.filter(user=self.follower2, event=event)), 1)
+        self.assertEqual(len(Notifications.get(user=self.actor, event=event)), 0)
+
+        Subscriptions.unfollow(follower=self.follower, event=event, actor=self.actor)
+        Events.add(**event_dict)
+        event_dict["actor"] = self.follower2
+        Events.add(**event_dict)
+
+        self.assertEqual(len(Notifications.get(user=self.follower, event=event)), 1)
+        self.assertEqual(len(Notifications.get(user=self.follower, event=event, actor=self.follower2)), 1)
+
+        Subscriptions.objects.bulk_create([
+            Subscriptions(follower=User.objects.create_user("fan_out_on_read_%s" % i,
+                                                            "fan_out_on_read_%s@test.com" % i,
+                                                            "pass"),
+                          event=event)
+            for i in range(20)])
+
+        event_dict["actor"] = self.actor
+        with QueryCounter() as counter_many:
+            Events.add(**event_dict)
+        self.assertEqual(counter.count, counter_many.count)
+
+        #the occurrences stored while the user did not follow the event are
+        #not delivered after a new follow
+        back = User.objects.create_user("fan_out_on_read_back", "fan_out_on_read_back@test.com", "pass")
+        Subscriptions.objects.create(follower=back, event=event)
+        Subscriptions.unfollow(follower=back, event=event)
+        for i in range(3):
+            Events.add(**event_dict)
+        Subscriptions.follow(follower=back, event=event)
+        self.assertEqual(len(Notifications.get(user=back, event=event)), 0)
+        Events.add(**event_dict)
+        self.assertEqual(len(Notifications.get(user=back, event=event)), 1)
+
+        #and the cursor moves when the user follows none of them
+        Subscriptions.unfollow(follower=back, event=event)
+        Events.add(**event_dict)
+        Notifications.get(user=back)
+        self.assertEqual(PullCursors.objects.get(user=back).last_occurrence,
+                         Occurrences.objects.filter(pull=True).order_by("-pk")[0].pk)
+
+        #a user back after a long time pulls in chunks
+        for i in range(4):
+            Events.add(**event_dict)
+        Subscriptions.objects.filter(follower=back, event=event).update(active=True)
+        with QueryCounter() as counter_chunks:
+            self.assertEqual(Notifications.pull(back, batch_size=2), 4)
+        with QueryCounter() as counter_chunk:
+            Events.add(**event_dict)
+            Notifications.pull(back, batch_size=2)
+        self.assertTrue(counter_chunks.count > counter_chunk.count)
+
+        #the occurrences are pulled once older than the delay
+        Events.add(**event_dict)
+        newest = Occurrences.objects.filter(pull=True).order_by("-pk")[0]
+        back.date_joined -= datetime.timedelta(seconds=120)
+        back.save()
+        with override_settings(NOTIFY_EVENTS_PULL_DELAY=60):
+            self.assertEqual(Notifications.pull(back), 0)
+            Occurrences.objects.filter(pk=newest.pk).update(created=F("created") - 60)
+            #the newest id is cached for NOTIFY_EVENTS_PULL_CHECK_INTERVAL
+            cache.delete(Occurrences.NEWEST_PULL_KEY)
+            self.assertEqual(Notifications.pull(back), 1)
+
+    def test_fan_out_on_read_threshold(self):
+        with override_settings(NOTIFY_EVENTS_PULL_THRESHOLD=1):
+            event = Events.create_event("fan_out_on_read_threshold", "is random", "c_random")
+        self.assertTrue(event.fan_out_on_read)
+
+        with override_settings(NOTIFY_EVENTS_PULL_THRESHOLD=1000000):
+            event = Events.create_event("fan_out_on_read_threshold_2", "is random", "c_random")
+        self.assertFalse(event.fan_out_on_read)
+
+    def test_registry(self):
+        event = Events.create_event("registry", "is random", "c_registry")
+
+        with QueryCounter() as counter:
+            self.assertEqual(Events.create_event("registry", "is random", "c_registry"), event)
+        self.assertEqual(counter.count, 0)
+
+        event.active = False
+        self.assertTrue(Events.create_event("registry", "is random", "c_registry").active)
+        event.save()
+        self.assertFalse(Events.create_event("registry", "is random", "c_registry").active)
+
+    def test_registry_other_process(self):
+        event = Events.create_event("registry_other_process", "is random", "c_registry")
+
+        with override_settings(NOTIFY_EVENTS_REGISTRY_CHECK_INTERVAL=0):
+            #changed by another process
+            Events.objects.filter(pk=event.pk).update(category="c_registry_2")
+            self.assertEqual(Events.create_event(event.name, "is random", "c_registry").category, "c_registry")
+
+            cache.set(registry.version_key, "other_process")
+            self.assertEqual(Events.create_event(event.name, "is random", "c_registry").category, "c_registry_2")
+
+    def test_partial_indexes(self):
+        if not indexes.supports_partial_indexes(connection):
+            self.skipTest("%s has no partial indexes" % connection.vendor)
+
+        self.assertTrue("%s_unread" % Notifications._meta.db_table in
+                        indexes.existing_indexes(Notifications._meta.db_table, connection))
+
+    def test_unread_counters(self):
+        event_dict = {"name": "unread_counters",
+                      "category": "c_unread_counters",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+
+        event = Events.create_event(event_dict["name"], event_dict["description"], event_dict["category"])
+        Subscriptions.objects.filter(follower=self.follower2, event=event).update(period=3600)
+        total = Notifications.unread_count(self.follower)
+        total2 = Notifications.unread_count(self.follower2)
+
+        Events.add(**event_dict)
+        Events.add(**event_dict)
+
+        self.assertEqual(Notifications.unread_count(self.follower), total + 2)
+        self.assertEqual(Notifications.unread_count(self.follower, "c_unread_counters"), 2)
+        self.assertEqual(Notifications.unread_count(self.follower2), total2)
+        self.assertEqual(Notifications.unread_count(self.follower2, "c_unread_counters"), 0)
+
+        Notifications.objects.filter(user=self.follower2, event=event).update(dispatch_time=0)
+        self.assertEqual(Notifications.unread_count(self.follower2, "c_unread_counters"), 2)
+
+        Subscriptions.unfollow(follower=self.follower, event=event, actor=self.actor)
+        self.assertEqual(Notifications.unread_count(self.follower), total)
+        self.assertEqual(Notifications.unread_count(self.follower, "c_unread_counters"), 0)
+        self.assertEqual(Notifications.mark_read(Notifications.objects.filter(user=self.follower, event=event)), 0)
+        self.assertEqual(Notifications.unread_count(self.follower), total)
+
+        #the unread notifications of a deleted event are discounted
+        event.delete()
+        self.assertEqual(Notifications.unread_count(self.follower2), total2)
+        self.assertEqual(Notifications.unread_count(self.follower2, "c_unread_counters"), 0)
+
+    def test_reconcile_unread_counters(self):
+        Events.add(name="reconcile_unread_counters",
+                   category="c_reconcile_unread_counters",
+                   description="is random",
+                   object_type="blog_post",
+                   object_id="00",
+                   actor=self.actor)
+        UnreadCounters.reconcile()
+        expected = Notifications.unread_count(self.follower)
+
+        UnreadCounters.objects.filter(user=self.follower, category="").update(count=999)
+        UnreadCounters.objects.filter(user=self.follower2, category="c_reconcile_unread_counters").delete()
+
+        self.assertEqual(UnreadCounters.reconcile(batch_size=2), 2)
+        self.assertEqual(Notifications.unread_count(self.follower), expected)
+        self.assertEqual(Notifications.unread_count(self.follower2, "c_reconcile_unread_counters"), 1)
+        self.assertEqual(UnreadCounters.reconcile(), 0)
+
+    def test_inbox(self):
+        user = User.objects.create_user("inbox", "inbox@test.com", "pass")
+        event_dict = {"name": "inbox",
+                      "category": "c_inbox",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+
+        for i in range(5):
+            event_dict["extra_data"] = {"i": i}
+            Events.add(**event_dict)
+        event_dict["name"] = "inbox_2"
+        event_dict["category"] = "c_inbox_2"
+        Events.add(**event_dict)
+
+        inbox = Inbox(user)
+        pages = [inbox.page(limit=2, category="c_inbox")]
+        while pages[-1].has_next:
+            with QueryCounter() as counter:
+                pages.append(inbox.page(pages[-1].next_cursor, limit=2, category="c_inbox"))
+            self.assertTrue(counter.count <= 2)
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([notification.data["i"] for page in pages for notification in page], [4, 3, 2, 1, 0])
+        self.assertEqual(len(inbox.page(limit=10)), 6)
+        self.assertEqual(len(inbox.page(limit=10, object_type="photo")), 0)
+        self.assertRaises(ValueError, inbox.page, "not a cursor")
+
+    def test_coalesce(self):
+        event_dict = {"name": "coalesce",
+                      "category": "c_coalesce",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+
+        event = Events.create_event(event_dict["name"], event_dict["description"], event_dict["category"])
+        event.coalesce = True
+        event.save()
+        Subscriptions.objects.filter(follower=self.follower, event=event).update(period=3600)
+
+        Events.add(**event_dict)
+        event_dict["actor"] = self.follower2
+        Events.add(**event_dict)
+        event_dict["actor"] = self.actor
+        Events.add(**event_dict)
+        event_dict["object_id"] = "01"
+        Events.add(**event_dict)
+
+        notify = Notifications.objects.get(user=self.follower, event=event, object_id="00")
+        self.assertEqual(notify.count, 3)
+        self.assertEqual(notify.actor, self.actor)
+        self.assertEqual(notify.actor_ids, [self.actor.pk, self.follower2.pk])
+        self.assertEqual(Notifications.objects.get(user=self.follower, event=event, object_id="01").count, 1)
+
+        #without period the notifications are not delayed, nothing to merge
+        self.assertEqual(Notifications.objects.filter(user=self.follower2, event=event).count(), 3)
+        self.assertEqual(Notifications.unread_count(self.follower, "c_coalesce"), 0)
+        Notifications.objects.filter(user=self.follower, event=event).update(dispatch_time=0)
+        self.assertEqual(Notifications.unread_count(self.follower, "c_coalesce"), 2)
+
+    def test_dispatcher(self):
+        event = Events.add(name="dispatcher",
+                           category="c_dispatcher",
+                           description="is random",
+                           object_type="blog_post",
+                           object_id="00",
+                           actor=self.actor,
+                           notify_channel="test_dispatcher")
+
+        sent = []
+
+        def handler(notifications):
+            notifications = [n for n in notifications if n.notify_channel == "test_dispatcher"]
+            sent.extend(notifications)
+            return [n for n in notifications if n.user == self.follower2]
+
+        dispatcher = Dispatcher(handler=handler)
+        while dispatcher.dispatch()["claimed"]:
+            pass
+
+        self.assertEqual(len(sent), Notifications.objects.filter(event=event).count())
+        self.assertEqual(Notifications.objects.get(user=self.follower, event=event).delivery,
+                         Notifications.DELIVERED)
+        failed = Notifications.objects.get(user=self.follower2, event=event)
+        self.assertEqual(failed.delivery, Notifications.CLAIMED)
+        self.assertTrue(failed.lease > time.time())
+
+        #tried again when the retry delay is over
+        Notifications.objects.filter(pk=failed.pk).update(lease=0)
+        with override_settings(NOTIFY_EVENTS_DISPATCH_MAX_ATTEMPTS=2):
+            stats = dispatcher.dispatch()
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(Notifications.objects.get(pk=failed.pk).delivery, Notifications.FAILED)
+        self.assertEqual(len(sent), Notifications.objects.filter(event=event).count() + 1)
+
+        #the read notifications are not sent, the claims of a dead dispatcher
+        #without attempts left fail
+        Events.add(name="dispatcher", category="c_dispatcher", description="is random",
+                   object_type="blog_post", object_id="01", actor=self.actor, notify_channel="test_dispatcher")
+        read = Notifications.objects.get(user=self.follower, event=event, object_id="01")
+        Notifications.mark_read(Notifications.objects.filter(pk=read.pk))
+        dead = Notifications.objects.get(user=self.follower2, event=event, object_id="01")
+        Notifications.objects.filter(pk=dead.pk).update(delivery=Notifications.CLAIMED, lease=0, attempts=2)
+        del sent[:]
+        with override_settings(NOTIFY_EVENTS_DISPATCH_MAX_ATTEMPTS=2):
+            while dispatcher.dispatch()["claimed"]:
+                pass
+        self.assertFalse([n for n in sent if n.pk in (read.pk, dead.pk)])
+        self.assertEqual(Notifications.objects.get(pk=read.pk).delivery, Notifications.UNDELIVERED)
+        self.assertEqual(Notifications.objects.get(pk=dead.pk).delivery, Notifications.FAILED)
+
+    def test_backends(self):
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                requests.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        path = tempfile.mktemp()
+        channels = {"default": {"BACKEND": "django_notify_events.backends.LocMemBackend"},
+                    "test_file": {"BACKEND": "django_notify_events.backends.FileBackend",
+                                  "OPTIONS": {"PATH": path}},
+                    "test_email": {"BACKEND": "django_notify_events.backends.EmailBackend"},
+                    "test_hook": {"BACKEND": "django_notify_events.backends.WebhookBackend",
+                                  "OPTIONS": {"URL": "http://127.0.0.1:%s/hook" % server.server_port,
+                                              "BATCH": 2}}}
+
+        event_dict = {"name": "backends",
+                      "category": "c_backends",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+        User.objects.create_user("backends_no_email", "", "pass")
+        event = Events.create_event(event_dict["name"], event_dict["description"], event_dict["category"])
+        for channel in ("test_locmem", "test_file", "test_email", "test_hook"):
+            event_dict["notify_channel"] = channel
+            Events.add(**event_dict)
+        followers = Notifications.objects.filter(event=event, notify_channel="test_file").count()
+
+        del backends.outbox[:]
+        del mail.outbox[:]
+        try:
+            with override_settings(NOTIFY_EVENTS_CHANNELS=channels):
+                Dispatcher().run(once=True)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(len([n for n in backends.outbox if n.notify_channel == "test_locmem"]), followers)
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        os.remove(path)
+        self.assertEqual(len(lines), followers)
+        self.assertEqual(lines[0]["event"], "backends")
+        self.assertEqual(len([m for m in mail.outbox if m.subject == "is random"]),
+                         User.objects.filter(follower_notification__event=event,
+                                             follower_notification__notify_channel="test_email")
+                                     .exclude(email="").count())
+        self.assertEqual(sum(len(request) for request in requests), followers)
+        self.assertEqual(len(requests), (followers + 1) // 2)
+        #the emails of the users without email failed
+        without_email = Notifications.objects.filter(event=event, notify_channel="test_email", user__email="")
+        self.assertTrue(without_email.exists())
+        self.assertEqual(without_email.filter(delivery=Notifications.DELIVERED).count(), 0)
+        self.assertEqual(Notifications.objects.filter(event=event)
+                                              .exclude(pk__in=without_email.values("pk"))
+                                              .exclude(delivery=Notifications.DELIVERED).count(), 0)
+
+        #an email that can not be sent fails alone
+        notifications = list(Notifications.objects.filter(event=event, notify_channel="test_email")
+                                                   .exclude(user__email="").select_related("user", "event"))
+        broken = notifications[0]
+        backend = backends.EmailBackend("test_email")
+        backend.body = lambda notification: 1 / 0 if notification is broken else "body"
+        del mail.outbox[:]
+        self.assertEqual(backend.send(notifications), [broken])
+        self.assertEqual(len(mail.outbox), len(notifications) - 1)
+
+    def test_follow_unfollow_query_count(self):
+        user = User.objects.create_user("follow_query_count", "follow_query_count@test.com", "pass")
+        event_dict = {"name": "follow_query_count_0",
+                      "category": "c_follow_query_count",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+
+        def toggle():
+            counts = []
+            for method, kwargs in ((Subscriptions.unfollow, {"actor": self.actor}),
+                                   (Subscriptions.follow, {"actor": self.actor}),
+                                   (Subscriptions.unfollow, {"object_type": "blog_post"}),
+                                   (Subscriptions.follow, {"object_type": "blog_post"}),
+                                   (Subscriptions.unfollow, {}),
+                                   (Subscriptions.follow, {})):
+                #an unread notification to mark as read
+                Events.add(**event_dict)
+                with QueryCounter() as counter:
+                    method(follower=user, **kwargs)
+                counts.append(counter.count)
+            return counts
+
+        for i in range(3):
+            Events.create_event("follow_query_count_%s" % i, "is random", "c_follow_query_count")
+        #the first pull of the user moves its cursor past the older occurrences
+        Notifications.pull(user)
+        few = toggle()
+
+        for i in range(3, 30):
+            Events.create_event("follow_query_count_%s" % i, "is random", "c_follow_query_count")
+        many = toggle()
+
+        self.assertEqual(few, many)
+        self.assertEqual(MuteRules.objects.filter(subscription__follower=user).count(), 0)
+        Events.add(**event_dict)
+        self.assertEqual(Notifications.unread_count(user, "c_follow_query_count"), 1)
+
+    def test_set_category_active(self):
+        events = [Events.create_event("category_active_%s" % i, "is random", "c_category_active")
+                  for i in range(5)]
+        ids = sorted(event.pk for event in events)
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        signals.category_changed.connect(receiver)
+        try:
+            with QueryCounter() as counter:
+                self.assertEqual(sorted(Events.deactivate_category("c_category_active")), ids)
+            #one select and one update, no matter how many events
+            self.assertEqual(counter.count, 2)
+            self.assertEqual(Events.objects.filter(pk__in=ids, active=True).count(), 0)
+
+            #the registry does not keep the old state of the events
+            self.assertFalse(Events.create_event("category_active_0", "is random", "c_category_active").active)
+
+            #nothing to change, nothing sent
+            self.assertEqual(Events.deactivate_category("c_category_active"), [])
+            self.assertEqual(sorted(Events.activate_category("c_category_active")), ids)
+        finally:
+            signals.category_changed.disconnect(receiver)
+
+        self.assertEqual([(r["category"], r["active"], sorted(r["event_ids"])) for r in received],
+                         [("c_category_active", False, ids), ("c_category_active", True, ids)])
+        self.assertTrue(Events.create_event("category_active_0", "is random", "c_category_active").active)
+
+    def test_batch_filter(self):
+        users = [User.objects.create_user("batch_filter_%s" % i, "batch_filter_%s@test.com" % i, "pass")
+                 for i in range(6)]
+        event = Events.create_event("batch_filter", "is random", "c_batch_filter")
+        calls = []
+
+        def batch_filter(follower_ids, **kwargs):
+            calls.append(list(follower_ids))
+            #one query for the whole batch
+            return (User.objects.filter(pk__in=follower_ids, username__startswith="batch_filter_")
+                                .exclude(username="batch_filter_0")
+                                .values_list("pk", flat=True))
+
+        event_dict = {"name": "batch_filter",
+                      "category": "c_batch_filter",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor,
+                      "batch_filter": batch_filter,
+                      #a filter can not be stored, the fan-out is synchronous
+                      "outbox": True}
+
+        Events.add(**event_dict)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(Notifications.objects.filter(event=event).values_list("user", flat=True)),
+                         [user.pk for user in users[1:]])
+
+        #one call per batch
+        Events.add(batch_size=2, **event_dict)
+        self.assertEqual(len(calls), 1 + (Subscriptions.get(event=event).count() - 1 + 1) // 2)
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 2 * (len(users) - 1))
+
+        event_dict["batch_filter"] = lambda follower_ids, **kwargs: True
+        self.assertRaises(TypeError, Events.add, **event_dict)
+
+    def test_purge(self):
+        user = User.objects.create_user("purge", "purge@test.com", "pass")
+        Events.create_event("purge", "is random", "c_purge")
+        event_dict = {"name": "purge",
+                      "category": "c_purge",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+        for i in range(8):
+            Events.add(**event_dict)
+
+        now = int(time.time())
+        ids = list(Notifications.objects.filter(user=user).order_by("pk").values_list("pk", flat=True))
+        #two old read, two old unread, two recent read, two recent unread
+        Notifications.objects.filter(pk__in=ids[:4]).update(dispatch_time=now - 40 * 86400)
+        Notifications.objects.filter(pk__in=ids[:2] + ids[4:6]).update(read=True)
+        UnreadCounters.reconcile()
+        Occurrences.objects.create(event=Events.objects.get(name="purge"), actor=self.actor,
+                                   object_type="blog_post", object_id="00",
+                                   created=now - 40 * 86400, status=Occurrences.DONE)
+        Occurrences.objects.create(event=Events.objects.get(name="purge"), actor=self.actor,
+                                   object_type="blog_post", object_id="00", pull=True,
+                                   created=now - 40 * 86400, status=Occurrences.DONE)
+
+        fd, path = tempfile.mkstemp(suffix=".gz")
+        os.close(fd)
+        try:
+            call_command("notify_purge", days=30, batch_size=1, archive=path)
+            archived = [json.loads(line) for line in gzip.open(path)]
+        finally:
+            os.remove(path)
+
+        self.assertEqual(sorted(row["id"] for row in archived if row["user"] == user.pk), ids[:2])
+        self.assertEqual(list(Notifications.objects.filter(user=user).order_by("pk").values_list("pk", flat=True)),
+                         ids[2:])
+        self.assertEqual(Occurrences.objects.filter(created__lt=now - 30 * 86400).count(), 0)
+        self.assertEqual(Notifications.unread_count(user, "c_purge"), 4)
+
+        #only the read notifications beyond the 3 newest are deleted
+        with override_settings(NOTIFY_EVENTS_RETENTION_MAX_PER_USER=3):
+            Notifications.purge()
+        self.assertEqual(list(Notifications.objects.filter(user=user).order_by("pk").values_list("pk", flat=True)),
+                         ids[2:4] + ids[5:])
+        self.assertEqual(Notifications.unread_count(user, "c_purge"), 4)
+
+    def test_metrics(self):
+        muted = User.objects.create_user("metrics_muted", "metrics_muted@test.com", "pass")
+        User.objects.create_user("metrics_filtered", "metrics_filtered@test.com", "pass")
+        event = Events.create_event("metrics", "is random", "c_metrics")
+        Subscriptions.unfollow(follower=muted, event=event, actor=self.actor)
+        Subscriptions.unfollow(follower=self.follower2, event=event)
+        subscriptions = Subscriptions.objects.filter(event=event).count()
+
+        event_dict = {"name": "metrics",
+                      "category": "c_metrics",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor,
+                      "filter": lambda subscription, **kwargs: subscription.follower.username != "metrics_filtered"}
+
+        sink = metrics.get_sink()
+        sink.reset()
+        with override_settings(NOTIFY_EVENTS_METRICS_SUPPRESSIONS=True):
+            Events.add(**event_dict)
+
+        written = Notifications.objects.filter(event=event).count()
+        self.assertEqual(sink.value("notifications_written"), written)
+        self.assertEqual(sink.value("recipients_considered"), subscriptions)
+        self.assertEqual(sink.value("recipients_suppressed", reason="self"), 1)
+        self.assertEqual(sink.value("recipients_suppressed", reason="inactive"), 1)
+        self.assertEqual(sink.value("recipients_suppressed", reason="muted_actor"), 1)
+        self.assertEqual(sink.value("recipients_suppressed", reason="rule"), 0)
+        self.assertEqual(sink.value("recipients_suppressed", reason="filter"), 1)
+        self.assertEqual(written, subscriptions - 4)
+        self.assertEqual(sink.value("occurrences", mode="push"), 1)
+
+        response = Client().get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('notify_events_recipients_suppressed_total{reason="muted_actor"} 1', response.content)
+        self.assertIn('notify_events_add_seconds_count{phase="resolve"} 1', response.content)
+        self.assertIn('notify_events_fan_out_seconds_count{phase="filter"}', response.content)
+
+        with override_settings(NOTIFY_EVENTS_METRICS_SINK=None):
+            self.assertEqual(metrics.get_sink(), None)
+            Events.add(**event_dict)
+            self.assertEqual(Client().get("/metrics").status_code, 404)
+        self.assertEqual(sink.value("occurrences", mode="push"), 1)
+
+    @override_settings(NOTIFY_EVENTS_SPARSE_SUBSCRIPTIONS=True, NOTIFY_EVENTS_PULL_DELAY=0)
+    def test_sparse_subscriptions(self):
+        muted = User.objects.create_user("sparse_muted", "sparse_muted@test.com", "pass")
+        away = User.objects.create_user("sparse_away", "sparse_away@test.com", "pass")
+
+        with QueryCounter() as few:
+            Events.create_event("sparse_few", "is random", "c_sparse")
+        User.objects.create_user("sparse_late", "sparse_late@test.com", "pass")
+        with QueryCounter() as many:
+            event = Events.create_event("sparse", "is random", "c_sparse")
+        self.assertEqual(few.count, many.count)
+        self.assertFalse(Subscriptions.objects.filter(event=event).exists())
+
+        Subscriptions.unfollow(follower=muted, event=event, actor=self.actor)
+        Subscriptions.unfollow(follower=away, category="c_sparse")
+        #only the users that changed something have rows
+        self.assertEqual(Subscriptions.objects.filter(event=event).count(), 2)
+
+        event_dict = {"name": "sparse",
+                      "category": "c_sparse",
+                      "description": "is random",
+                      "object_type": "blog_post",
+                      "object_id": "00",
+                      "actor": self.actor}
+        Events.add(**event_dict)
+        notified = set(Notifications.objects.filter(event=event).values_list("user", flat=True))
+        self.assertEqual(notified, set(User.objects.exclude(pk__in=[muted.pk, away.pk, self.actor.pk])
+                                                   .values_list("pk", flat=True)))
+
+        #the outbox worker resumes in follower order over both kinds
+        Subscriptions.follow(follower=away, category="c_sparse")
+        occurrence = Occurrences.objects.create(event=event, actor=self.actor, object_type="blog_post",
+                                                object_id="01", created=int(time.time()),
+                                                last_follower=self.follower.pk)
+        occurrence.worker = "sparse"
+        occurrence.status = Occurrences.PROCESSING
+        occurrence.save()
+        occurrence.process()
+        notified = set(Notifications.objects.filter(event=event, object_id="01").values_list("user", flat=True))
+        self.assertEqual(notified, set(User.objects.filter(pk__gt=self.follower.pk)
+                                                   .exclude(pk__in=[muted.pk, self.actor.pk])
+                                                   .values_list("pk", flat=True)))
+
+        #fan-out on read
+        Events.objects.filter(pk=event.pk).update(fan_out_on_read=True)
+        registry.invalidate()
+        event_dict["object_id"] = "02"
+        Events.add(**event_dict)
+        for user, count in ((self.follower, 1), (muted, 0), (away, 1)):
+            self.assertEqual(Notifications.get(user=user, event=event, object_id="02").count(), count)
+
+    @override_settings(NOTIFY_EVENTS_SHARDS=["shard_0", "shard_1"])
+    def test_shards(self):
+        Events.create_event("shards", "is random", "c_shards")
+        event = Events.add(name="shards",
+                           category="c_shards",
+                           description="is random",
+                           object_type="blog_post",
+                           object_id="00",
+                           actor=self.actor,
+                           notify_channel="test_shards")
+
+        followers = list(Subscriptions.get(event=event).exclude(follower=self.actor)
+                                                       .values_list("follower", flat=True))
+        self.assertFalse(Notifications.objects.using("default").filter(event=event).exists())
+        for alias, remainder in (("shard_0", 0), ("shard_1", 1)):
+            stored = sorted(Notifications.objects.using(alias).filter(event=event).values_list("user", flat=True))
+            self.assertEqual(stored, sorted(pk for pk in followers if pk % 2 == remainder))
+
+        for user in (self.follower, self.follower2):
+            page = Inbox(user).page(category="c_shards")
+            self.assertEqual([(n.user_id, n.event.name, n.actor) for n in page.notifications],
+                             [(user.pk, "shards", self.actor)])
+            self.assertEqual(Notifications.unread_count(user, "c_shards"), 1)
+        self.assertRaises(TypeError, Notifications.get, event=event)
+
+        Subscriptions.unfollow(follower=self.follower, category="c_shards")
+        self.assertEqual(Notifications.unread_count(self.follower, "c_shards"), 0)
+        self.assertEqual(Notifications.unread_count(self.follower2, "c_shards"), 1)
+        Subscriptions.follow(follower=self.follower, category="c_shards")
+
+        #the dispatcher visits every shard
+        sent = []
+
+        def handler(notifications):
+            sent.extend(n for n in notifications if n.notify_channel == "test_shards")
+            return []
+
+        dispatcher = Dispatcher(handler=handler, batch_size=1000)
+        while dispatcher.dispatch()["claimed"]:
+            pass
+        #the notification read by the unfollow is not sent
+        self.assertEqual(sorted(n.user_id for n in sent), sorted(pk for pk in followers if pk != self.follower.pk))
+        for alias in ("shard_0", "shard_1"):
+            self.assertFalse(Notifications.objects.using(alias).filter(event=event, read=False)
+                                                               .exclude(delivery=Notifications.DELIVERED)
+                                                               .exists())
+
+        #the notifications of a deleted user are deleted in its shard
+        gone = User.objects.create_user("shards_deleted", "shards_deleted@test.com", "pass")
+        Subscriptions.objects.create(follower=gone, event=event)
+        Events.add(name="shards", category="c_shards", description="is random",
+                   object_type="blog_post", object_id="01", actor=self.actor)
+        Events.add(name="shards", category="c_shards", description="is random",
+                   object_type="blog_post", object_id="02", actor=gone)
+        self.assertEqual(Notifications.get(user=gone).count(), 1)
+        gone_pk = gone.pk
+        gone.delete()
+        for alias in ("shard_0", "shard_1"):
+            self.assertFalse(Notifications.objects.using(alias).filter(Q(user=gone_pk) | Q(actor=gone_pk)).exists())
+
+    @override_settings(NOTIFY_EVENTS_REPLICAS={"default": ["replica"]})
+    def test_replicas(self):
+        #the replica of the tests is empty, it shows where the reads go
+        user = User.objects.create_user("replicas", "replicas@test.com", "pass")
+        event = Events.create_event("replicas", "is random", "c_replicas")
+        Events.add(name="replicas",
+                   category="c_replicas",
+                   description="is random",
+                   object_type="blog_post",
+                   object_id="00",
+                   actor=self.actor)
+        sticky = "django_notify_events:sticky:%s" % user.pk
+        cache.delete(sticky)
+
+        self.assertEqual(Notifications.get(user=user).db, "replica")
+        self.assertEqual(Notifications.get(user=user).count(), 0)
+        self.assertEqual(Subscriptions.get(follower=user).db, "replica")
+        self.assertEqual(Notifications.unread_count(user, "c_replicas"), 0)
+        #the fan-out reads the primary
+        self.assertEqual(Subscriptions.get(event=event).db, "default")
+
+        #the writes go to the primary, then the user reads from it
+        self.assertEqual(Notifications.mark_read(Notifications.get(user=user, event=event)), 1)
+        self.assertEqual(Notifications.objects.filter(user=user, event=event, read=False).count(), 0)
+        self.assertEqual(Notifications.get(user=user).db, "default")
+
+        cache.delete(sticky)
+        Subscriptions.unfollow(follower=user, event=event)
+        self.assertEqual(Subscriptions.get(follower=user).db, "default")
+        self.assertFalse(Subscriptions.get(follower=user, event=event).exists())
+        Subscriptions.follow(follower=user, event=event)
+        cache.delete(sticky)
+
+    def test_shared_payload(self):
+        user = User.objects.create_user("shared_payload", "shared_payload@test.com", "pass")
+        event = Events.create_event("shared_payload", "is random", "c_shared_payload")
+        payload = {"body": "x" * 2048}
+        Events.add(name="shared_payload",
+                   category="c_shared_payload",
+                   description="is random",
+                   object_type="blog_post",
+                   object_id="00",
+                   actor=self.actor,
+                   extra_data=payload)
+
+        #the payload is stored once
+        rows = Notifications.objects.filter(event=event)
+        self.assertEqual(set(rows.values_list("own_extra_data", flat=True)), set(["{}"]))
+        self.assertEqual(len(set(rows.values_list("occurrence", flat=True))), 1)
+        occurrence = Occurrences.objects.get(pk=rows[0].occurrence_id)
+        self.assertEqual(json.loads(occurrence.extra_data), payload)
+
+        #and read back with the inbox in the same query
+        Notifications.pull(user)
+        with QueryCounter() as counter:
+            page = Inbox(user).page(event=event)
+            self.assertEqual([n.data for n in page.notifications], [payload])
+        with QueryCounter() as counter_without_payload:
+            Inbox(user).page(event=event)
+        self.assertEqual(counter.count, counter_without_payload.count)
+
+        #the occurrence outlives the retention while it has notifications
+        Occurrences.objects.filter(pk=occurrence.pk).update(created=int(time.time()) - 40 * 86400)
+        Occurrences.purge(days=30)
+        self.assertTrue(Occurrences.objects.filter(pk=occurrence.pk).exists())
+        Notifications.mark_read(rows)
+        rows.delete()
+        Occurrences.purge(days=30)
+        self.assertFalse(Occurrences.objects.filter(pk=occurrence.pk).exists())
+
+    def test_add_many(self):
+        users = [User.objects.create_user("add_many_%s" % i, "add_many_%s@test.com" % i, "pass") for i in range(3)]
+        first = Events.create_event("add_many_0", "is random", "c_add_many")
+        second = Events.create_event("add_many_1", "is random", "c_add_many")
+        Events.create_event("add_many_off", "is random", "c_add_many_off")
+        Events.deactivate_category("c_add_many_off")
+
+        def occurrences(count, object_id, actors):
+            for i in range(count):
+                yield {"name": ("add_many_0", "add_many_1", "add_many_off")[i % 3],
+                       "category": ("c_add_many", "c_add_many", "c_add_many_off")[i % 3],
+                       "description": "is random",
+                       "object_type": ("blog_post", "photo")[i % 2],
+                       "object_id": object_id,
+                       "actor": actors[i % len(actors)],
+                       "extra_data": {"i": i}}
+
+        def add_many(count, object_id):
+            with QueryCounter() as counter:
+                Events.add_many(occurrences(count, object_id, [self.actor]), batch_size=10000, outbox=False)
+            return counter.count
+
+        #the first one also creates the unread counters
+        add_many(3, "warm")
+        #the queries do not depend on the number of occurrences
+        self.assertEqual(add_many(3, "few"), add_many(12, "many"))
+
+        Subscriptions.unfollow(follower=users[0], actor=self.follower)
+        Subscriptions.unfollow(follower=users[1], event=second, object_type="photo")
+        unread = Notifications.unread_count(users[2], "c_add_many")
+        summary = Events.add_many(occurrences(6, "rules", [self.actor, self.follower]), outbox=False)
+
+        self.assertEqual([item["mode"] for item in summary[:3]], ["push", "push", "inactive"])
+        self.assertEqual(summary[2]["occurrence"], None)
+        for item in summary:
+            if item["occurrence"] is not None:
+                self.assertEqual(Notifications.objects.filter(occurrence=item["occurrence"]).count(),
+                                 item["notifications"])
+
+        #the same notifications as add one by one
+        subscribers = Subscriptions.objects.filter(event=first).count()
+        self.assertEqual(summary[0]["notifications"], subscribers - 1)
+        #the follower muted for users[0], the photos of second for users[1]
+        self.assertEqual(summary[1]["notifications"], subscribers - 3)
+        notification = Notifications.objects.get(occurrence=summary[3]["occurrence"], user=users[2])
+        self.assertEqual((notification.actor, notification.object_type, notification.data),
+                         (self.follower, "photo", {"i": 3}))
+        self.assertEqual(Notifications.unread_count(users[2], "c_add_many"), unread + 4)
+
+        self.assertRaises(TypeError, Events.add_many, [{"name": "add_many_0"}])
+
+    def test_idempotency_key(self):
+        event = Events.create_event("idempotent", "is random", "c_idempotent")
+        sink = metrics.get_sink()
+        subscribers = Subscriptions.objects.filter(event=event).count()
+
+        def add(key, outbox=False):
+            return Events.add(name="idempotent", category="c_idempotent", description="is random",
+                              object_type="blog_post", object_id="00", actor=self.actor,
+                              idempotency_key=key, outbox=outbox)
+
+        add("idempotent-1")
+        self.assertEqual(Notifications.objects.filter(event=event).count(), subscribers - 1)
+
+        #a retry is a single indexed lookup
+        duplicates = sink.value("occurrences", mode="duplicate")
+        with QueryCounter() as counter:
+            add("idempotent-1")
+        self.assertTrue(counter.count <= 2)
+        self.assertEqual(sink.value("occurrences", mode="duplicate"), duplicates + 1)
+        self.assertEqual(Notifications.objects.filter(event=event).count(), subscribers - 1)
+        self.assertEqual(Occurrences.objects.filter(idempotency_key="idempotent-1").count(), 1)
+
+        #in the outbox and with add_many
+        add("idempotent-2", outbox=True)
+        add("idempotent-2", outbox=True)
+        self.assertEqual(Occurrences.objects.filter(idempotency_key="idempotent-2").count(), 1)
+        occurrence = {"name": "idempotent", "category": "c_idempotent", "description": "is random",
+                      "object_type": "blog_post", "object_id": "00", "actor": self.actor}
+        summary = Events.add_many([dict(occurrence, idempotency_key="idempotent-1"),
+                                   dict(occurrence, idempotency_key="idempotent-3"),
+                                   dict(occurrence, idempotency_key="idempotent-3"),
+                                   occurrence], outbox=False)
+        self.assertEqual([item["mode"] for item in summary], ["duplicate", "push", "duplicate", "push"])
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 3 * (subscribers - 1))
+
+        #a key stored by another producer between the read of the keys and
+        #the insert is a duplicate too
+        bulk_create = Occurrences.__dict__["bulk_create"]
+
+        def racing_bulk_create(cls, occurrences, batch_size=None):
+            Occurrences.bulk_create = bulk_create
+            Events.add(name="idempotent", category="c_idempotent", description="is random",
+                       object_type="blog_post", object_id="00", actor=self.actor,
+                       idempotency_key="idempotent-4", outbox=False)
+            return Occurrences.bulk_create(occurrences, batch_size)
+
+        Occurrences.bulk_create = classmethod(racing_bulk_create)
+        try:
+            summary = Events.add_many([dict(occurrence, idempotency_key="idempotent-4"),
+                                       dict(occurrence, idempotency_key="idempotent-5")], outbox=False)
+        finally:
+            Occurrences.bulk_create = bulk_create
+        self.assertEqual([item["mode"] for item in summary], ["duplicate", "push"])
+        self.assertEqual(Occurrences.objects.filter(idempotency_key__in=["idempotent-4", "idempotent-5"]).count(), 2)
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 5 * (subscribers - 1))
+
+        #once expired the key can be used again
+        Occurrences.objects.filter(idempotency_key="idempotent-1").update(created=F("created") - 3600)
+        self.assertEqual(Occurrences.expire_keys(ttl=60), 1)
+        add("idempotent-1")
+        self.assertEqual(Notifications.objects.filter(event=event).count(), 6 * (subscribers - 1))
+
+    def test_pubsub(self):
+        user = User.objects.create_user("pubsub", "pubsub@test.com", "pass")
+        delayed = User.objects.create_user("pubsub_delayed", "pubsub_delayed@test.com", "pass")
+        event = Events.create_event("pubsub", "is random", "c_pubsub")
+        Subscriptions.objects.filter(event=event, follower=delayed).update(period=3600)
+
+        def add(object_id):
+            Events.add(name="pubsub", category="c_pubsub", description="is random",
+                       object_type="blog_post", object_id=object_id, actor=self.actor, outbox=False)
+
+        broker = pubsub.get_broker()
+        subscription = broker.subscribe(user.pk)
+        waiting = broker.subscribe(delayed.pk)
+        self.assertEqual(subscription.get(0.05), [])
+        add("01")
+        self.assertEqual(subscription.get(0), [{"event": event.pk}])
+        #the notifications delayed by the period are woken by the dispatcher
+        self.assertEqual(waiting.get(0), [])
+        notification = Notifications.objects.get(user=delayed, event=event)
+        Occurrences.objects.filter(pk=notification.occurrence_id).update(created=F("created") - 3600)
+        Notifications.objects.filter(pk=notification.pk).update(dispatch_time=F("dispatch_time") - 3600)
+        dispatcher = Dispatcher(handler=lambda notifications: [], batch_size=1000)
+        while dispatcher.dispatch()["claimed"]:
+            pass
+        self.assertEqual(waiting.get(0), [{"event": event.pk}])
+        subscription.close()
+        waiting.close()
+        self.assertEqual(broker.subscriptions.get(user.pk), None)
+
+        client = Client()
+        client.login(username="pubsub", password="pass")
+        self.assertEqual(Client().get("/poll").status_code, 403)
+        self.assertEqual(client.get("/poll", {"cursor": "!"}).status_code, 400)
+        for timeout in ("nan", "inf", "-1"):
+            self.assertEqual(client.get("/poll", {"timeout": timeout}).status_code, 400)
+
+        #without new notifications the long-poll returns after the timeout
+        start = time.time()
+        response = json.loads(client.get("/poll", {"timeout": 0.2}).content)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(response["notifications"], [])
+
+        cursor = response["cursor"]
+        add("02")
+        add("03")
+        response = json.loads(client.get("/poll", {"cursor": cursor}).content)
+        self.assertEqual([notification["object_id"] for notification in response["notifications"]], ["02", "03"])
+        last = response["cursor"]
+        self.assertEqual(last, encode_cursor(Notifications.objects.get(user=user, object_id="03")))
+
+        with override_settings(NOTIFY_EVENTS_PUBSUB_STREAM_SECONDS=0.3, NOTIFY_EVENTS_PUBSUB_HEARTBEAT=0.1):
+            response = client.get("/stream", HTTP_LAST_EVENT_ID=cursor)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            content = "".join(response.streaming_content)
+        events = [chunk for chunk in content.split("\n\n") if chunk.startswith("id: ")]
+        self.assertEqual(len(events), 2)
+        self.assertEqual(json.loads(events[1].split("data: ")[1])["object_id"], "03")
+        self.assertTrue(": keepalive" in content)
+
+        #the occurrences in fan-out on read mode wake every client, the
+        #pulled notifications come after the cursor even when older
+        User.objects.filter(pk=user.pk).update(date_joined=user.date_joined - datetime.timedelta(seconds=120))
+        pulled = Events.create_event("pubsub_pull", "is random", "c_pubsub")
+        pulled.fan_out_on_read = True
+        pulled.save()
+        subscription = broker.subscribe(user.pk)
+        Events.add(name="pubsub_pull", category="c_pubsub", description="is random",
+                   object_type="blog_post", object_id="04", actor=self.actor, outbox=False)
+        self.assertEqual(subscription.get(0), [{"pull": True}])
+        subscription.close()
+        Occurrences.objects.filter(event=pulled).update(created=F("created") - 60)
+        cache.delete(Occurrences.NEWEST_PULL_KEY)
+        with override_settings(NOTIFY_EVENTS_PULL_DELAY=0):
+            response = json.loads(client.get("/poll", {"cursor": last, "timeout": 0}).content)
+        self.assertEqual([notification["object_id"] for notification in response["notifications"]], ["04"])
@@ -5,6 +5,10 @@ from django.conf.urls import patterns, include, url
 # admin.autodiscover()
 
 urlpatterns = patterns('',
+    url(r'^metrics$', 'django_notify_events.views.metrics_view', name='notify_events_metrics'),
+    url(r'^poll$', 'django_notify_events.views.poll_view', name='notify_events_poll'),
+    url(r'^stream$', 'django_notify_events.views.stream_view', name='notify_events_stream'),
+
     # Examples:
     # url(r'^$', 'django_notify_events.views.home', name='home'),
     # url(r'^django_notify_events/', include('django_notify_events.foo.urls')),
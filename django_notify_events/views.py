@@ -0,0 +1,157 @@
+import json
+import math
+import time
+
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
+
+from django_notify_events import metrics, pubsub
+from django_notify_events.backends import serialize
+from django_notify_events.conf import settings
+from django_notify_events.inbox import Inbox, InboxPage, decode_cursor, encode_cursor
+
+
+def metrics_view(request):
+    """
+        metrics of the process in the prometheus text format
+    """
+    sink = metrics.get_sink()
+    if not hasattr(sink, "prometheus"):
+        raise Http404("the metrics sink can not be exported")
+    return HttpResponse(sink.prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _wait(inbox, cursor, limit, subscription, timeout, check=True, rechecks=None):
+    """
+        the notifications after cursor, read again only when pubsub wakes
+        the user, an empty page after timeout seconds. Without broker they
+        are read again at the end of the timeout. The occurrences in fan-out
+        on read mode are only pulled NOTIFY_EVENTS_PULL_DELAY seconds after
+        their wake-up, the times of the reads they need are kept in rechecks
+        (shared by the waits of a stream).
+    """
+    if rechecks is None:
+        rechecks = []
+    deadline = time.time() + timeout
+    if check:
+        page = inbox.newer(cursor, limit)
+        if page.notifications:
+            return page
+
+    while True:
+        now = time.time()
+        if rechecks and rechecks[0] <= now:
+            while rechecks and rechecks[0] <= now:
+                rechecks.pop(0)
+            page = inbox.newer(cursor, limit, primary=True)
+            if page.notifications:
+                return page
+            continue
+
+        remaining = deadline - now
+        if remaining <= 0:
+            return InboxPage([], cursor)
+        if subscription is None:
+            time.sleep(remaining)
+            return inbox.newer(cursor, limit)
+
+        woken = False
+        for message in subscription.get(min(remaining, rechecks[0] - now) if rechecks else remaining):
+            if "pull" not in message:
+                woken = True
+                continue
+            #past the delay and the cache of the newest pull occurrence
+            at = time.time() + settings.PULL_DELAY + settings.PULL_CHECK_INTERVAL + 1
+            if not rechecks or at - rechecks[-1] >= 1:
+                rechecks.append(at)
+        if woken:
+            page = inbox.newer(cursor, limit, primary=True)
+            if page.notifications:
+                return page
+
+
+def _arguments(request, inbox, cursor):
+    if cursor is None:
+        cursor = inbox.latest_cursor()
+    else:
+        decode_cursor(cursor)
+    return cursor, min(max(int(request.GET.get("limit", 20)), 1), 100)
+
+
+def poll_view(request):
+    """
+        long-poll of the unread notifications of the user after cursor
+        (without cursor the ones after the newest), returns them in json
+        with the cursor of the next call as soon as there are some, or an
+        empty list after timeout seconds (NOTIFY_EVENTS_PUBSUB_TIMEOUT at
+        most)
+    """
+    if not request.user.is_authenticated():
+        return HttpResponseForbidden()
+
+    inbox = Inbox(request.user)
+    broker = pubsub.get_broker()
+    try:
+        cursor, limit = _arguments(request, inbox, request.GET.get("cursor"))
+        timeout = float(request.GET.get("timeout", settings.PUBSUB_TIMEOUT))
+        if math.isnan(timeout) or math.isinf(timeout) or timeout < 0:
+            raise ValueError("invalid timeout %r" % request.GET["timeout"])
+        timeout = min(timeout, settings.PUBSUB_TIMEOUT)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    #subscribed before the first read, nothing written after it is missed
+    subscription = broker.subscribe(request.user.pk) if broker is not None else None
+    try:
+        page = _wait(inbox, cursor, limit, subscription, timeout if subscription is not None else 0)
+    finally:
+        if subscription is not None:
+            subscription.close()
+
+    return HttpResponse(json.dumps({"notifications": [serialize(notification) for notification in page],
+                                    "cursor": page.next_cursor}),
+                        content_type="application/json")
+
+
+def _stream(inbox, cursor, limit):
+    broker = pubsub.get_broker()
+    subscription = broker.subscribe(inbox.user.pk) if broker is not None else None
+    try:
+        end = time.time() + settings.PUBSUB_STREAM_SECONDS
+        check = True
+        rechecks = []
+        while time.time() < end:
+            page = _wait(inbox, cursor, limit, subscription, min(settings.PUBSUB_HEARTBEAT, end - time.time()),
+                         check, rechecks)
+            if not page.notifications:
+                yield ": keepalive\n\n"
+            for notification in page:
+                yield "id: %s\nevent: notification\ndata: %s\n\n" % (encode_cursor(notification),
+                                                                      json.dumps(serialize(notification)))
+            cursor = page.next_cursor
+            #a full page can be followed by more notifications
+            check = len(page) >= limit
+    finally:
+        if subscription is not None:
+            subscription.close()
+
+
+def stream_view(request):
+    """
+        server-sent events of the unread notifications of the user after the
+        cursor (the Last-Event-ID of a reconnection or the cursor parameter),
+        one "notification" event each with its cursor as id. The stream ends
+        after NOTIFY_EVENTS_PUBSUB_STREAM_SECONDS, the client reconnects.
+    """
+    if not request.user.is_authenticated():
+        return HttpResponseForbidden()
+
+    inbox = Inbox(request.user)
+    try:
+        cursor, limit = _arguments(request, inbox,
+                                   request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("cursor"))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = StreamingHttpResponse(_stream(inbox, cursor, limit), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response